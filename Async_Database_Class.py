@@ -0,0 +1,158 @@
+import asyncio
+import asyncpg
+import pandas as pd
+
+from Database_Class import DatabaseConnection
+from myconfig import user, password, dbname
+
+
+async def create_pool(min_size=1, max_size=10):
+    # A single pool can be shared between many AsyncDatabaseConnection objects so tables are worked on concurrently
+    pool = await asyncpg.create_pool(database=dbname, user=user, host='localhost', password=password, port=5432,
+                                     min_size=min_size, max_size=max_size)
+    print(f'Connection pool to database "{dbname}" on user "{user}" opened')
+    return pool
+
+
+class AsyncDatabaseConnection:
+    # Shares the type conversion and SQL building of the blocking class so both produce identical statements
+    sql_type_conversion = DatabaseConnection.sql_type_conversion
+    _column_dtypes = DatabaseConnection._column_dtypes
+    _build_query = DatabaseConnection._build_query
+    _sample_clause = staticmethod(DatabaseConnection._sample_clause)
+    _where_clause = staticmethod(DatabaseConnection._where_clause)
+
+    def __init__(self, table_name, pool=None):
+        self.table_name = table_name
+        self.pool = pool
+        # Only pools opened by this object are closed by close_connection
+        self.owns_pool = pool is None
+
+    async def connect(self, min_size=1, max_size=10):
+        if self.pool is None:
+            self.pool = await create_pool(min_size, max_size)
+        return self
+
+    async def create_table(self, columns, data, id_included=False):
+        dtypes = self._column_dtypes(data)
+        column_definitions = [f"{columns[i]} {dtypes[i]}" for i in range(len(columns))]
+        if not id_included:
+            # Will produce signature ID column if none included
+            column_definitions.insert(0, "id bigserial PRIMARY KEY")
+        create_table_command = f"CREATE TABLE {self.table_name} ({', '.join(column_definitions)})"
+        try:
+            await self.pool.execute(create_table_command)
+        except asyncpg.PostgresError:
+            print(
+                f'Table {self.table_name} could not be created - it may already exist')
+            return
+        print(f'Table "{self.table_name}" successfully created')
+
+    async def insert_rows(self, columns, data):
+        if len(data) == 0:
+            print('No data to insert')
+            return
+        column_types = [await self._column_type(column) for column in columns]
+        # Converting to object first gives plain Python values, which is what asyncpg encodes
+        records = data[columns].astype(object)
+        for column, column_type in zip(columns, column_types):
+            if column_type.startswith('character varying') or column_type == 'text':
+                # Populates all null values in str columns to match those of null floats "nan"
+                records[column] = records[column].fillna('nan')
+            elif column_type.startswith('bit'):
+                # asyncpg only encodes bit columns from BitString values
+                records[column] = [None if pd.isna(value) else asyncpg.BitString('1' if value else '0')
+                                   for value in records[column]]
+        # Any other missing value is sent as NULL, as asyncpg cannot encode NaN for most column types
+        records = records.where(records.notna(), None)
+        entries = [tuple(row) for row in records.values.tolist()]
+        async with self.pool.acquire() as connection:
+            await connection.copy_records_to_table(self.table_name, records=entries, columns=list(columns))
+        print(str(len(entries)) + ' records successfully inserted into database')
+
+    async def query(self, conditions=None, order=None, row_number=None, columns=None, group_by=None,
+                    aggregates=None, distinct=False):
+        query_command = self._build_query(conditions, order, row_number, columns, group_by, aggregates, distinct)
+        async with self.pool.acquire() as connection:
+            statement = await connection.prepare(query_command)
+            result = await statement.fetch()
+            result_columns = [attribute.name for attribute in statement.get_attributes()]
+        return pd.DataFrame([tuple(record) for record in result], columns=result_columns)
+
+    async def stream(self, conditions=None, order=None, row_number=None, columns=None, chunk_size=1000):
+        # Yields the result in DataFrame chunks from a server-side cursor so large results never sit in memory at once
+        query_command = self._build_query(conditions, order, row_number, columns)
+        async with self.pool.acquire() as connection:
+            async with connection.transaction():
+                statement = await connection.prepare(query_command)
+                result_columns = [attribute.name for attribute in statement.get_attributes()]
+                cursor = await statement.cursor()
+                while True:
+                    records = await cursor.fetch(chunk_size)
+                    if len(records) == 0:
+                        break
+                    yield pd.DataFrame([tuple(record) for record in records], columns=result_columns)
+
+    async def update_rows(self, columns, data, conditions=None):
+        data = data.copy()
+        for i in range(len(columns)):
+            if type(data[columns[i]].iloc[0]) == str:
+                data[columns[i]] = data[columns[i]].fillna('nan')
+        row_entries = data[columns].astype(object).values.tolist()
+        if conditions is None:
+            print('No conditions given, update cannot be completed')
+            return
+        elif len(row_entries) == 0:
+            print('No new rows given, update cannot be completed')
+            return
+        # Values are sent as parameters and cast to each column's type by the server
+        column_types = [await self._column_type(column) for column in columns]
+        assignments = ", ".join(f"{columns[i]} = ${i + 1}::text::{column_types[i]}" for i in range(len(columns)))
+        update_command = f"UPDATE {self.table_name} SET {assignments} {self._where_clause(conditions)}"
+        # Booleans are sent as 1 or 0, which both bit and boolean columns accept
+        await self.pool.execute(update_command, *[str(int(value)) if type(value) == bool else str(value)
+                                                  for value in row_entries[0]])
+        print(f'Specified rows have been updated')
+
+    async def delete_rows(self, conditions=None):
+        if conditions is None or len(conditions) == 0:
+            # Will delete all rows if no conditions given
+            await self.pool.execute(f"TRUNCATE TABLE {self.table_name}")
+        else:
+            await self.pool.execute(f"DELETE FROM {self.table_name} {self._where_clause(conditions)}")
+        print('Rows successfully deleted')
+
+    async def save_table(self, path):
+        # COPY streams the table straight into the file rather than building a DataFrame first
+        async with self.pool.acquire() as connection:
+            await connection.copy_from_query(f"SELECT * FROM {self.table_name}", output=path, format='csv',
+                                             header=True)
+        print(f'SQL table {self.table_name} successfully saved')
+
+    async def close_connection(self):
+        if self.owns_pool and self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+            print('PostgreSQL connection pool is closed')
+
+    async def _column_type(self, column_name):
+        return await self.pool.fetchval("SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+                                        f"WHERE attrelid = '{self.table_name}'::regclass AND attname = $1",
+                                        column_name)
+
+    # Condition and ordering helpers are identical to those of the blocking class
+    equal = staticmethod(DatabaseConnection.equal)
+    greater_than = staticmethod(DatabaseConnection.greater_than)
+    less_than = staticmethod(DatabaseConnection.less_than)
+    between = staticmethod(DatabaseConnection.between)
+    not_equal = staticmethod(DatabaseConnection.not_equal)
+    is_null = staticmethod(DatabaseConnection.is_null)
+    not_null = staticmethod(DatabaseConnection.not_null)
+    aggregate = staticmethod(DatabaseConnection.aggregate)
+    asc = staticmethod(DatabaseConnection.asc)
+    desc = staticmethod(DatabaseConnection.desc)
+
+
+async def run_concurrently(*operations):
+    # Convenience wrapper for running several table operations at once, e.g. exports of different tables
+    return await asyncio.gather(*operations)
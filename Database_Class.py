@@ -1,59 +1,462 @@
-import psycopg2
-import pandas as pd
-import numpy as np
+import io
+import re
+import csv
+import json
+import importlib.util
+import os
+import struct
+import time
+import queue
+import shutil
+import threading
+import datetime as dt
 
-from psycopg2.extras import execute_values
+from lazy import lazy_import
 from myconfig import user, password, dbname
 
+# Heavy modules are only imported once they are first used, which keeps start-up of both front-ends fast
+psycopg2 = lazy_import('psycopg2')
+psycopg2_extras = lazy_import('psycopg2.extras')
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+csv_reader = lazy_import('csv_reader')
+
+
+def connect():
+    return psycopg2.connect(
+        dbname=dbname, user=user, host='localhost', password=password, port='5432')
+
+
+def run_in_snapshot(items, task, workers, coordinator=None):
+    # Runs task(cursor, index, item) for every item on up to workers connections at once, returning the results in
+    # item order. Every worker imports the snapshot of the coordinator's transaction, so together they read one
+    # consistent version of the database. A coordinator passed in is left open for its owner to close
+    if coordinator is None:
+        coordinator = connect()
+        coordinator.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        try:
+            return run_in_snapshot(items, task, workers, coordinator)
+        finally:
+            coordinator.rollback()
+            coordinator.close()
+    coordinator_cursor = coordinator.cursor()
+    coordinator_cursor.execute("SELECT pg_export_snapshot()")
+    snapshot = coordinator_cursor.fetchone()[0]
+    item_queue = queue.Queue()
+    for index, item in enumerate(items):
+        item_queue.put((index, item))
+    results = [None] * len(items)
+    errors = []
+
+    def worker():
+        worker_connection = connect()
+        try:
+            worker_connection.set_session(isolation_level='REPEATABLE READ', readonly=True)
+            worker_cursor = worker_connection.cursor()
+            worker_cursor.execute(f"SET TRANSACTION SNAPSHOT '{snapshot}'")
+            while True:
+                try:
+                    index, item = item_queue.get_nowait()
+                except queue.Empty:
+                    break
+                results[index] = task(worker_cursor, index, item)
+        except Exception as error:
+            errors.append(error)
+        finally:
+            worker_connection.rollback()
+            worker_connection.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # A failed item stops its worker, so the run as a whole fails rather than returning missing results
+    if len(errors) > 0:
+        raise errors[0]
+    return results
+
+
+def export_schema(directory, schema='public', tables=None, file_format='csv', workers=4):
+    # Lists the tables to export, largest first so the slowest exports start straight away
+    coordinator = connect()
+    coordinator.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    coordinator_cursor = coordinator.cursor()
+    coordinator_cursor.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = %s "
+                               "AND table_type = 'BASE TABLE' "
+                               "ORDER BY pg_total_relation_size(quote_ident(table_schema) || '.' || "
+                               "quote_ident(table_name)) DESC", (schema,))
+    schema_tables = [row[0] for row in coordinator_cursor.fetchall()]
+    if tables is not None:
+        schema_tables = [table for table in schema_tables if table in tables]
+    os.makedirs(directory, exist_ok=True)
+    timings = []
+
+    def export_table(worker_cursor, index, table):
+        start = time.perf_counter()
+        path = os.path.join(directory, f"{table}.{file_format}")
+        gather_command = f'SELECT * FROM "{schema}"."{table}"'
+        if file_format == 'parquet':
+            worker_cursor.execute(gather_command)
+            columns = [description[0] for description in worker_cursor.description]
+            pd.DataFrame(worker_cursor.fetchall(), columns=columns).to_parquet(path, index=False)
+        else:
+            with open(path, 'w') as file:
+                worker_cursor.copy_expert(f"COPY ({gather_command}) TO STDOUT WITH CSV HEADER", file)
+        seconds = time.perf_counter() - start
+        timings.append((table, seconds, os.path.getsize(path)))
+        print(f'Table "{table}" exported in {seconds:.2f}s')
+
+    # The coordinator keeps its transaction open so every worker reads from the snapshot the tables were listed in
+    try:
+        run_in_snapshot(schema_tables, export_table, workers, coordinator)
+    finally:
+        coordinator.rollback()
+        coordinator.close()
+    print(f'{len(timings)} tables from schema "{schema}" successfully exported to {directory}')
+    return pd.DataFrame(timings, columns=['table', 'seconds', 'bytes'])
+
+
+def import_directory(directory, workers=4, indexes=None, foreign_keys=None, sample_rows=1000, id_included=None):
+    # indexes maps a table name to the columns to index, foreign_keys lists (table, column, ref_table, ref_column)
+    # id_included applies to every file, by default each file is checked for its own id column
+    indexes = indexes or {}
+    foreign_keys = foreign_keys or []
+    csv_files = [file for file in os.listdir(directory) if file.lower().endswith('.csv')]
+    # Largest files are loaded first so the longest loads are not left until the end
+    csv_files.sort(key=lambda file: os.path.getsize(os.path.join(directory, file)), reverse=True)
+    timeline = []
+    failed = []
+    started = time.perf_counter()
+
+    def timed(phase, task, action, connection):
+        start = time.perf_counter()
+        result = action(connection)
+        end = time.perf_counter()
+        timeline.append((phase, task, threading.current_thread().name, start - started, end - started))
+        print(f'{phase}: {task} finished in {end - start:.2f}s')
+        return result
+
+    # Columns that foreign keys point at need a primary key or unique constraint, which is added on creation
+    referenced = {(ref_table, ref_column) for _, _, ref_table, ref_column in foreign_keys}
+
+    def create(connection, table, columns, sample, file_id_included):
+        if not database_connection.create_table(columns, sample, id_included=file_id_included):
+            return False
+        for ref_table, column in referenced:
+            if ref_table == table and column in columns:
+                constraint = 'PRIMARY KEY' if column == 'id' else 'UNIQUE'
+                connection.cursor().execute(f"ALTER TABLE {table} ADD {constraint} ({column})")
+        return True
+
+    # Tables are created first, inferring column types from a sample of each file
+    database_connection = DatabaseConnection(None)
+    load_tasks = []
+    for file in csv_files:
+        path = os.path.join(directory, file)
+        table = os.path.splitext(file)[0].lower()
+        try:
+            sample = pd.read_csv(path, nrows=sample_rows)
+            columns = [column for column in sample.columns]
+            database_connection.table_name = table
+            file_id_included = 'id' in columns if id_included is None else id_included
+            created = timed('create', table,
+                            lambda connection: create(connection, table, columns, sample, file_id_included),
+                            database_connection.connection)
+        except Exception as error:
+            print(f'create: {table} failed - {error}')
+            created = False
+        # A table that could not be created is reported as failed rather than loaded into
+        if not created:
+            failed.append(('create', table))
+            continue
+
+        def load(connection, table=table, path=path, columns=columns):
+            with open(path) as file_data:
+                connection.cursor().copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH CSV HEADER",
+                                                file_data)
+        load_tasks.append((table, load))
+    database_connection.close_connection()
+
+    # Indexes and foreign keys are built once every table has its data
+    build_tasks = []
+    for table, index_columns in indexes.items():
+        for column in index_columns:
+            build_tasks.append((f'{table}.{column} index', lambda connection, table=table, column=column:
+                                connection.cursor().execute(f"CREATE INDEX ON {table} ({column})")))
+    for table, column, ref_table, ref_column in foreign_keys:
+        build_tasks.append((f'{table}.{column} foreign key',
+                            lambda connection, table=table, column=column, ref_table=ref_table, ref_column=ref_column:
+                            connection.cursor().execute(f"ALTER TABLE {table} ADD FOREIGN KEY ({column}) "
+                                                        f"REFERENCES {ref_table} ({ref_column})")))
+
+    for phase, tasks in (('load', load_tasks), ('build', build_tasks)):
+        task_queue = queue.Queue()
+        for task in tasks:
+            task_queue.put(task)
+
+        def worker(phase=phase, task_queue=task_queue):
+            try:
+                worker_connection = connect()
+            except Exception as error:
+                print(f'{phase}: worker could not connect - {error}')
+                return
+            worker_connection.autocommit = True
+            while True:
+                try:
+                    task, action = task_queue.get_nowait()
+                except queue.Empty:
+                    break
+                # Any error, such as a file that is not UTF-8, fails only its own task
+                try:
+                    timed(phase, task, action, worker_connection)
+                except Exception as error:
+                    failed.append((phase, task))
+                    print(f'{phase}: {task} failed - {error}')
+            worker_connection.close()
+
+        threads = [threading.Thread(target=worker, name=f'worker-{i}') for i in range(min(workers, len(tasks)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Tasks left in the queue were never run because no worker could connect
+        while not task_queue.empty():
+            task, action = task_queue.get_nowait()
+            failed.append((phase, task))
+
+    report = pd.DataFrame(timeline, columns=['phase', 'task', 'worker', 'start', 'end'])
+    report['seconds'] = report['end'] - report['start']
+    # Summarises how much wall-clock time each phase took
+    for phase, phase_report in report.groupby('phase', sort=False):
+        print(f'{phase} phase: {len(phase_report)} tasks, '
+              f'{phase_report["end"].max() - phase_report["start"].min():.2f}s wall clock, '
+              f'{phase_report["seconds"].sum():.2f}s total work')
+    failed_tables = {task for phase, task in failed if phase in ('create', 'load')}
+    print(f'{len(csv_files) - len(failed_tables)} of {len(csv_files)} tables imported from {directory} '
+          f'in {time.perf_counter() - started:.2f}s')
+    if len(failed) > 0:
+        print(f'Failed: {", ".join(f"{phase} {task}" for phase, task in failed)}')
+    return report
+
 
 class DatabaseConnection:
-    def __init__(self, table_name):
+    # Takes the name of a python data type and returns the equivalent SQL data type name
+    sql_type_conversion = {
+        'float64': 'real',
+        'str': 'varchar(200)',
+        'int64': 'int',
+        'bool': 'bit',
+        'bool_': 'bit',
+    }
+    # Maps a range partition interval name to its pandas period frequency
+    partition_frequencies = {
+        'day': 'D',
+        'month': 'M',
+        'year': 'Y',
+    }
+    # Fixed-width PostgreSQL types and the big-endian numpy dtype of their binary COPY representation
+    binary_copy_formats = {
+        'smallint': '>i2',
+        'integer': '>i4',
+        'bigint': '>i8',
+        'real': '>f4',
+        'double precision': '>f8',
+        'boolean': 'u1',
+        'date': '>i4',
+    }
+    # Smallest and largest values each integer column type can hold
+    integer_ranges = {
+        'smallint': (-2 ** 15, 2 ** 15 - 1),
+        'integer': (-2 ** 31, 2 ** 31 - 1),
+        'bigint': (-2 ** 63, 2 ** 63 - 1),
+    }
+    # Lower bounds of the length buckets used when profiling text columns
+    length_buckets = [0, 1, 5, 10, 20, 50, 100]
+    # Type OIDs returned in cursor descriptions mapped to the binary COPY dtype used when decoding results
+    binary_result_formats = {
+        16: 'u1',
+        20: '>i8',
+        21: '>i2',
+        23: '>i4',
+        700: '>f4',
+        701: '>f8',
+        1082: '>i4',
+    }
+
+    def __init__(self, table_name, slow_query_threshold=None, slow_query_log='slow_queries.log', max_retries=5,
+                 retry_delay=0.5):
         self.table_name = table_name
-        # Takes a python data type and returns the equivalent SQL data type name
-        self.sql_type_conversion = {
-            np.float64: 'real',
-            str: 'varchar(200)',
-            np.int64: 'int',
-            bool: 'bit',
-        }
-        try:
-            # Establishes connection to PostgreSQL database
-            self.connection = psycopg2.connect(
-                dbname=dbname, user=user, host='localhost', password=password, port='5432')
-            self.connection.autocommit = True
-            self.cursor = self.connection.cursor()
-            print(f'Connected to database "{dbname}" on user "{user}"')
-        except:
-            print(f'Unable to connect to database {dbname}')
+        # Dropped connections are retried this many times, waiting twice as long after each failed attempt
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # Queries slower than the threshold (in seconds) are written to the slow query log with their plan
+        self.slow_query_threshold = slow_query_threshold
+        self.slow_query_log = slow_query_log
+        # The connection is only opened when the first statement needs it, so helper-only use never connects
+        self._connection = None
+        self._cursor = None
 
-    def create_table(self, columns, data, id_included=False):
-        # Scans through DataFrame and determines the equivalent SQL data type of each column
+    @property
+    def connection(self):
+        if self._connection is None:
+            self._connect()
+        return self._connection
+
+    @property
+    def cursor(self):
+        if self._cursor is None:
+            self._connect()
+        return self._cursor
+
+    def _connect(self):
+        for attempt in range(self.max_retries + 1):
+            try:
+                # Establishes connection to PostgreSQL database
+                self._connection = connect()
+                self._connection.autocommit = True
+                self._cursor = self._connection.cursor()
+                print(f'Connected to database "{dbname}" on user "{user}"')
+                return
+            except psycopg2.OperationalError:
+                if attempt == self.max_retries:
+                    print(f'Unable to connect to database {dbname}')
+                    raise
+                delay = self._backoff(attempt)
+                print(f'Unable to connect to database {dbname}, retrying in {delay:.1f}s')
+                time.sleep(delay)
+
+    def _backoff(self, attempt):
+        return min(self.retry_delay * 2 ** attempt, 30)
+
+    def check_connection(self):
+        # Health check which confirms the server still answers on the current connection
+        if self._connection is None or self._connection.closed:
+            return False
         try:
-            dtypes = [self.sql_type_conversion[(
-                type(entry))] for entry in data.dropna().iloc[0]]
-        except IndexError:
-            dtypes = [self.sql_type_conversion[(
-                type(entry))] for entry in data.iloc[0]]
+            self._cursor.execute("SELECT 1")
+            self._cursor.fetchone()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return False
+
+    def reconnect(self):
+        if self._connection is not None and not self._connection.closed:
+            self._connection.close()
+        self._connection = None
+        self._cursor = None
+        self._connect()
+
+    def _with_retry(self, action):
+        # Runs an action which is safe to repeat, reconnecting and trying again if the connection drops
+        for attempt in range(self.max_retries + 1):
+            try:
+                return action()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as error:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                print(f'Connection problem ({str(error).strip()}), reconnecting in {delay:.1f}s')
+                time.sleep(delay)
+                self.reconnect()
+
+    def _load_batch(self, load, checkpoint=None, part=None):
+        if checkpoint is None:
+            load()
+            return
+
+        def attempt():
+            # A batch already recorded in the checkpoint table committed before the connection dropped
+            self.cursor.execute("SELECT 1 FROM load_checkpoints WHERE load_id = %s AND part = %s", (checkpoint, part))
+            if self.cursor.fetchone() is not None:
+                return
+            # The batch and its checkpoint commit together, so a batch is never applied twice
+            self.connection.autocommit = False
+            try:
+                load()
+                self.cursor.execute("INSERT INTO load_checkpoints (load_id, part) VALUES (%s, %s)", (checkpoint, part))
+                self.connection.commit()
+            finally:
+                if not self._connection.closed:
+                    self._connection.rollback()
+                    self._connection.autocommit = True
+
+        self._with_retry(attempt)
+
+    def _completed_parts(self, checkpoint):
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS load_checkpoints (load_id text, part text, "
+                            "completed_at timestamptz DEFAULT now(), PRIMARY KEY (load_id, part))")
+        self.cursor.execute("SELECT part FROM load_checkpoints WHERE load_id = %s", (checkpoint,))
+        return {row[0] for row in self.cursor.fetchall()}
+
+    def clear_checkpoint(self, checkpoint):
+        self.cursor.execute("DELETE FROM load_checkpoints WHERE load_id = %s", (checkpoint,))
+
+    def create_table(self, columns, data, id_included=False, partition_by=None, partition_column=None,
+                     partition_interval=None):
+        dtypes = self._column_dtypes(data)
+        if partition_by is not None:
+            partition_by = partition_by.upper()
+            if partition_by not in ('RANGE', 'LIST', 'HASH'):
+                print(f'{partition_by} is not a valid partitioning method - use range, list or hash')
+                return False
+            # Range tables default to monthly partitions, which is resolved here so the column is retyped to match
+            if partition_by == 'RANGE':
+                partition_interval = partition_interval or 'month'
+            # Date intervals need a real date column so that partition bounds compare correctly
+            if partition_by == 'RANGE' and partition_interval in self.partition_frequencies:
+                dtypes[columns.index(partition_column)] = 'date'
+        # Concatenates each column name with its SQL data type to produce create table query
+        column_definitions = [f"{columns[i]} {dtypes[i]}" for i in range(len(columns))]
         if not id_included:
             # Will produce signature ID column if none included
-            create_table_command = f"CREATE TABLE {self.table_name} (id bigserial PRIMARY KEY, "
-            # Concatenates each column name with its SQL data type to produce create table query
-            for i in range(len(columns) - 1):
-                create_table_command += f"{columns[i]} {dtypes[i]}, "
-        else:
-            create_table_command = f"CREATE TABLE {self.table_name} ("
-            for i in range(len(columns) - 1):
-                create_table_command += f"{columns[i]} {dtypes[i]}, "
-        create_table_command += f"{columns[-1]} {dtypes[-1]})"
+            if partition_by is None:
+                column_definitions.insert(0, "id bigserial PRIMARY KEY")
+            else:
+                # Primary keys on a partitioned table must contain the partition column
+                column_definitions.insert(0, "id bigserial")
+                column_definitions.append(f"PRIMARY KEY (id, {partition_column})")
+        create_table_command = f"CREATE TABLE {self.table_name} ({', '.join(column_definitions)})"
+        if partition_by is not None:
+            create_table_command += f" PARTITION BY {partition_by} ({partition_column})"
         try:
             self.cursor.execute(create_table_command)
         except:
             print(
                 f'Table {self.table_name} could not be created - it may already exist')
-            return
+            return False
+        if partition_by == 'HASH':
+            # Hash partitions are fixed up front, partition_interval is the number of partitions
+            modulus = int(partition_interval or 4)
+            for remainder in range(modulus):
+                self.cursor.execute(f"CREATE TABLE {self.table_name}_p{remainder} PARTITION OF {self.table_name} "
+                                    f"FOR VALUES WITH (MODULUS {modulus}, REMAINDER {remainder})")
+        elif partition_by == 'RANGE':
+            # Stores the range width on the table so later inserts know which partitions to create
+            self.cursor.execute(f"COMMENT ON TABLE {self.table_name} IS "
+                                f"'partition_interval={partition_interval}'")
         print(f'Table "{self.table_name}" successfully created')
+        return True
+
+    def _column_dtypes(self, data):
+        # Scans through DataFrame and determines the equivalent SQL data type of each column
+        try:
+            return [self.sql_type_conversion[(
+                type(entry).__name__)] for entry in data.dropna().iloc[0]]
+        except IndexError:
+            return [self.sql_type_conversion[(
+                type(entry).__name__)] for entry in data.iloc[0]]
 
-    def insert_rows(self, columns, data):
+    def insert_rows(self, columns, data, reject_path=None, on_conflict=None, conflict_columns=None,
+                    dedupe_key=None, progress=None, batch_size=10000, checkpoint=None, checkpoint_part=''):
+        # The conflict target is checked before anything is written so an unusable key fails straight away
+        conflict_clause = self._conflict_clause(columns, on_conflict, conflict_columns)
+        data = self._drop_duplicate_rows(data, dedupe_key, on_conflict, conflict_columns)
+        if reject_path is not None:
+            data = self._reject_invalid_rows(columns, data, reject_path)
+            if len(data) == 0:
+                print('No valid data to insert')
+                return
         # Populates all null values in str columns to match those of null floats "nan"
         for i in range(len(columns)):
             if type(data[columns[i]].iloc[0]) == str:
@@ -63,34 +466,888 @@ class DatabaseConnection:
         if len(entries) == 0:
             print('No data to insert')
             return
+        # Creates any partitions the new rows need so Postgres can route them on insert
+        self._ensure_partitions(data)
         # Formats columns list to return a bracketed list without quotations around each column name
         formatted_cols = "(" + "{0}".format(', '.join(map(str, columns))) + ")"
         insert_command = f"INSERT INTO {self.table_name} {formatted_cols} VALUES %s"
-        # Uses execute_values to insert all data at once, only making a single commit
-        execute_values(self.cursor, insert_command, entries)
-        print(str(len(entries)) + ' records successfully inserted into database')
+        insert_command += conflict_clause
+        # Batches named in a checkpoint were committed by an earlier, interrupted run and are skipped
+        completed = self._completed_parts(checkpoint) if checkpoint is not None else set()
+        # A conflict clause always targets columns the rows carry, so a replayed batch hits it instead of inserting
+        # the rows twice
+        replay_safe = on_conflict is not None
+        # Uses execute_values to insert the data in batches so progress can be reported as rows are committed
+        for start in range(0, len(entries), batch_size):
+            batch = entries[start:start + batch_size]
+            part = f'{checkpoint_part}{start}'
+            if part not in completed:
+                def load(batch=batch):
+                    psycopg2_extras.execute_values(self.cursor, insert_command, batch, page_size=batch_size)
+                # Without a checkpoint a batch is only retried when repeating it cannot duplicate rows
+                if checkpoint is None and replay_safe:
+                    self._with_retry(load)
+                else:
+                    self._load_batch(load, checkpoint, part)
+            if progress is not None:
+                progress.update(rows_committed=len(batch))
+        # A checkpoint passed in directly is finished once every batch is in, insert_csv clears its own at the end
+        if checkpoint is not None and checkpoint_part == '':
+            self.clear_checkpoint(checkpoint)
+        if on_conflict is None:
+            print(str(len(entries)) + ' records successfully inserted into database')
+        else:
+            print(f'{len(entries)} records successfully written to database ({on_conflict} on conflict)')
 
-    def query(self, conditions=None, order=None, row_number=None):
-        # If no row_number or conditions given, will return all rows by default
-        if conditions is None:
-            query_command = f"SELECT * FROM {self.table_name} "
+    def insert_csv(self, path, workers=None, binary=False, reject_path=None, on_conflict=None,
+                   conflict_columns=None, dedupe_key=None, progress=None, checkpoint=None):
+        # Parses the file in parallel and loads each segment as soon as it has been parsed
+        if progress is not None and progress.total_bytes is None:
+            progress.total_bytes = os.path.getsize(path)
+        total = 0
+        # A fixed segment count keeps segment offsets the same across runs, so an offset identifies a segment
+        segments = 64 if checkpoint is not None else None
+        for offset, data in csv_reader.read_csv_parallel(path, workers, segments=segments, progress=progress,
+                                                          with_offsets=True):
+            columns = [column for column in data.columns]
+            if binary:
+                self.copy_rows_binary(columns, data, reject_path=reject_path, on_conflict=on_conflict,
+                                      conflict_columns=conflict_columns, dedupe_key=dedupe_key, progress=progress,
+                                      checkpoint=checkpoint, checkpoint_part=f'{offset}:')
+            else:
+                self.insert_rows(columns, data, reject_path=reject_path, on_conflict=on_conflict,
+                                 conflict_columns=conflict_columns, dedupe_key=dedupe_key, progress=progress,
+                                 checkpoint=checkpoint, checkpoint_part=f'{offset}:')
+            total += len(data)
+        if checkpoint is not None:
+            self.clear_checkpoint(checkpoint)
+        if progress is not None:
+            progress.finish()
+        print(f'{total} records from {path} successfully loaded into "{self.table_name}"')
+
+    def _conflict_target(self, columns, conflict_columns=None):
+        # Existing rows can only be matched on a unique key the incoming rows carry, a key filled in by a default
+        # such as a bigserial id is new for every row and would never conflict
+        if type(conflict_columns) == str:
+            conflict_columns = [conflict_columns]
+        conflict_columns = conflict_columns or self.get_primary_key()
+        if len(conflict_columns) == 0:
+            raise ValueError(f'Table "{self.table_name}" has no primary key - pass the unique column(s) that '
+                             f'identify a row as conflict_columns')
+        missing = [column for column in conflict_columns if column not in columns]
+        if len(missing) > 0:
+            raise ValueError(f'Conflict column(s) {", ".join(missing)} are not in the data being written, so existing '
+                             f'rows can never be matched - pass the unique column(s) the file contains')
+        return conflict_columns
+
+    def _conflict_clause(self, columns, on_conflict, conflict_columns=None):
+        # skip leaves existing rows untouched, replace overwrites them with the incoming values
+        if on_conflict is None:
+            return ""
+        if on_conflict not in ('skip', 'replace'):
+            raise ValueError(f'{on_conflict} is not a valid conflict mode - use skip or replace')
+        conflict_columns = self._conflict_target(columns, conflict_columns)
+        updates = [f"{column} = EXCLUDED.{column}" for column in columns if column not in conflict_columns]
+        if on_conflict == 'skip' or len(updates) == 0:
+            return f" ON CONFLICT ({', '.join(conflict_columns)}) DO NOTHING"
+        return f" ON CONFLICT ({', '.join(conflict_columns)}) DO UPDATE SET {', '.join(updates)}"
+
+    def _drop_duplicate_rows(self, data, dedupe_key=None, on_conflict=None, conflict_columns=None):
+        # Replacing needs each key only once per statement, so the conflict key is deduplicated too
+        if dedupe_key is None and on_conflict == 'replace':
+            dedupe_key = self._conflict_target(data.columns, conflict_columns)
+        if dedupe_key is None:
+            return data
+        if type(dedupe_key) == str:
+            dedupe_key = [dedupe_key]
+        # Compares the exact key values of each row, so only rows with the same key are ever dropped
+        duplicates = data.duplicated(subset=dedupe_key, keep='last')
+        if duplicates.any():
+            print(f'{int(duplicates.sum())} duplicate rows removed on {", ".join(dedupe_key)}')
+        return data[~duplicates.to_numpy()].copy()
+
+    def validate_rows(self, columns, data):
+        # Checks every value against the target column's type, length and nullability, returning a reason per row
+        metadata = self._column_metadata()
+        reasons = pd.Series('', index=data.index, dtype=object)
+        for column in columns:
+            if column not in metadata:
+                reasons += f'{column}: column does not exist; '
+                continue
+            data_type, max_length, nullable = metadata[column]
+            values = data[column]
+            missing = values.isna()
+            problems = []
+            if not nullable:
+                problems.append((missing, 'null in NOT NULL column'))
+            if data_type in self.integer_ranges:
+                numbers = pd.to_numeric(values, errors='coerce')
+                lowest, highest = self.integer_ranges[data_type]
+                problems.append((~missing & numbers.isna(), 'not a number'))
+                problems.append((~numbers.isna() & (numbers % 1 != 0), 'not a whole number'))
+                problems.append((~numbers.isna() & ((numbers < lowest) | (numbers > highest)),
+                                 f'out of range for {data_type}'))
+            elif data_type in ('real', 'double precision', 'numeric'):
+                problems.append((~missing & pd.to_numeric(values, errors='coerce').isna(), 'not a number'))
+            elif data_type == 'date' or data_type.startswith('timestamp'):
+                # Date formats depend on the session DateStyle, so the server itself decides which values it accepts
+                invalid = self._invalid_inputs(values[~missing], data_type)
+                problems.append((~missing & values.astype(str).isin(invalid), 'not a valid date'))
+            elif data_type == 'boolean':
+                problems.append((~missing & ~values.astype(str).str.lower().isin(
+                    ['true', 'false', 't', 'f', '1', '0', 'yes', 'no', '1.0', '0.0']), 'not a boolean'))
+            elif max_length is not None:
+                problems.append((~missing & (values.astype(str).str.len() > max_length),
+                                 f'longer than {max_length} characters'))
+            for bad_rows, message in problems:
+                reasons[bad_rows] += f'{column}: {message}; '
+        return reasons.str.rstrip('; ')
+
+    def _invalid_inputs(self, values, data_type):
+        # Returns the distinct values the server would refuse to read as data_type, checked in one round trip
+        distinct = values.astype(str).unique().tolist()
+        if len(distinct) == 0:
+            return set()
+        if self.connection.server_version >= 160000:
+            check = "pg_input_is_valid(value, %s)"
         else:
-            query_command = f" SELECT * FROM {self.table_name} WHERE "
-            if len(conditions) > 1:
-                for i in range(len(conditions) - 1):
-                    query_command += f"{conditions[i]} OR "
-                query_command += conditions[-1]
+            # Older servers have no pg_input_is_valid, so a session-only function tries each cast instead
+            self.cursor.execute("CREATE OR REPLACE FUNCTION pg_temp.input_is_valid(value text, type_name text) "
+                                "RETURNS boolean AS $$ BEGIN EXECUTE format('SELECT %L::%s', value, type_name); "
+                                "RETURN true; EXCEPTION WHEN others THEN RETURN false; END $$ LANGUAGE plpgsql")
+            check = "pg_temp.input_is_valid(value, %s)"
+        self.cursor.execute(f"SELECT value FROM unnest(%s::text[]) AS value WHERE NOT {check}", (distinct, data_type))
+        return {row[0] for row in self.cursor.fetchall()}
+
+    def _reject_invalid_rows(self, columns, data, reject_path):
+        # Writes failing rows with their reasons to the reject file and returns only the rows that passed. The row
+        # label is the data row in the source file, as segments read by insert_csv are numbered from its start
+        reasons = self.validate_rows(columns, data)
+        rejected = reasons != ''
+        if rejected.any():
+            rejects = data[rejected].copy()
+            rejects['reject_reason'] = reasons[rejected]
+            rejects.to_csv(reject_path, mode='a', header=not os.path.exists(reject_path), index_label='row')
+            print(f'{int(rejected.sum())} invalid rows written to {reject_path}')
+        return data[~rejected].copy()
+
+    def _column_metadata(self):
+        get_metadata_command = "SELECT column_name, data_type, character_maximum_length, is_nullable " \
+                               f"FROM information_schema.columns WHERE table_name = '{self.table_name}'"
+        self.cursor.execute(get_metadata_command)
+        return {column_name: (data_type, max_length, is_nullable == 'YES')
+                for column_name, data_type, max_length, is_nullable in self.cursor.fetchall()}
+
+    def copy_rows_binary(self, columns, data, chunk_size=100000, reject_path=None, on_conflict=None,
+                         conflict_columns=None, dedupe_key=None, progress=None, checkpoint=None, checkpoint_part=''):
+        # Loads rows with binary COPY so numbers are sent as raw bytes and never formatted as text
+        conflict_clause = self._conflict_clause(columns, on_conflict, conflict_columns)
+        data = self._drop_duplicate_rows(data, dedupe_key, on_conflict, conflict_columns)
+        if reject_path is not None:
+            data = self._reject_invalid_rows(columns, data, reject_path)
+            if len(data) == 0:
+                print('No valid data to insert')
+                return
+        for i in range(len(columns)):
+            if type(data[columns[i]].iloc[0]) == str:
+                data[columns[i]].fillna('nan', inplace=True)
+        if len(data) == 0:
+            print('No data to insert')
+            return
+        column_types = self.get_column_types()
+        self._ensure_partitions(data)
+        # COPY cannot resolve conflicts, so conflicting loads go through a staging table first
+        target_table = self.table_name if on_conflict is None else f"{self.table_name}_staging"
+        if on_conflict is not None:
+            self.cursor.execute(f"CREATE TEMP TABLE {target_table} (LIKE {self.table_name} INCLUDING DEFAULTS)")
+        copy_command = f"COPY {target_table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT binary)"
+        # The staging table only lives on this connection, so only direct loads can be checkpointed
+        checkpoint = checkpoint if on_conflict is None else None
+        completed = self._completed_parts(checkpoint) if checkpoint is not None else set()
+        for start in range(0, len(data), chunk_size):
+            chunk = data.iloc[start:start + chunk_size]
+            part = f'{checkpoint_part}{start}'
+            if part not in completed:
+                payload = self._encode_binary_copy(columns, chunk, column_types)
+                self._load_batch(lambda: self.cursor.copy_expert(copy_command, io.BytesIO(payload)), checkpoint, part)
+            # Rows in a staging table are not committed to the target yet, so they are counted after the merge
+            if progress is not None and on_conflict is None:
+                progress.update(rows_committed=len(chunk))
+        if on_conflict is None:
+            if checkpoint is not None and checkpoint_part == '':
+                self.clear_checkpoint(checkpoint)
+            print(str(len(data)) + ' records successfully inserted into database')
+            return
+        self.cursor.execute(f"INSERT INTO {self.table_name} ({', '.join(columns)}) "
+                            f"SELECT {', '.join(columns)} FROM {target_table}" + conflict_clause)
+        written = self.cursor.rowcount
+        self.cursor.execute(f"DROP TABLE {target_table}")
+        if progress is not None:
+            progress.update(rows_committed=len(data))
+        print(f'{written} of {len(data)} records successfully written to database ({on_conflict} on conflict)')
+
+    def _encode_binary_copy(self, columns, data, column_types):
+        row_count = len(data)
+        # Each column is encoded to a field length per row plus its payload bytes
+        field_lengths = []
+        payloads = []
+        for column in columns:
+            sql_type = column_types[column]
+            # Missing values of any kind (None, NaN, NaT or pd.NA) are written as NULL with a field length of -1
+            nulls = pd.isna(data[column]).to_numpy()
+            if sql_type in self.binary_copy_formats:
+                if sql_type == 'date':
+                    days = pd.to_datetime(data[column]).to_numpy().astype('datetime64[D]')
+                    values = (days - np.datetime64('2000-01-01', 'D')).astype(np.int64)
+                    values[nulls] = 0
+                else:
+                    # Nulls are filled with a placeholder before casting and skipped when the payload is built
+                    native = np.dtype(self.binary_copy_formats[sql_type]).newbyteorder('=')
+                    values = data[column].to_numpy(dtype=native, na_value=0)
+                encoded = values.astype(self.binary_copy_formats[sql_type])
+                width = encoded.dtype.itemsize
+                lengths = np.where(nulls, -1, width).astype(np.int64)
+                payload = encoded.view(np.uint8).reshape(row_count, width)[~nulls].ravel()
+            elif sql_type == 'bit':
+                # A bit(1) value is its bit length followed by one byte holding the bit
+                values = data[column].to_numpy(dtype=bool, na_value=False)
+                lengths = np.where(nulls, -1, 5).astype(np.int64)
+                payload = np.zeros((row_count, 5), dtype=np.uint8)
+                payload[:, 3] = 1
+                payload[:, 4] = np.where(values, 0x80, 0)
+                payload = payload[~nulls].ravel()
+            elif sql_type.startswith('varchar') or sql_type in ('text', 'character varying'):
+                values = data[column].to_numpy()
+                encoded_values = [None if null else str(value).encode('utf-8') for value, null in zip(values, nulls)]
+                lengths = np.array([-1 if value is None else len(value) for value in encoded_values], dtype=np.int64)
+                payload = np.frombuffer(b''.join(value for value in encoded_values if value is not None),
+                                        dtype=np.uint8)
+            else:
+                raise ValueError(f'Column {column} has type {sql_type}, which has no binary COPY encoder')
+            field_lengths.append(lengths)
+            payloads.append(payload)
+
+        # Works out where every row and field starts in the output buffer
+        header = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+        field_sizes = np.stack([4 + np.maximum(lengths, 0) for lengths in field_lengths], axis=1)
+        row_sizes = 2 + field_sizes.sum(axis=1)
+        row_offsets = len(header) + np.concatenate(([0], np.cumsum(row_sizes)[:-1]))
+        buffer = np.empty(len(header) + int(row_sizes.sum()) + 2, dtype=np.uint8)
+        buffer[:len(header)] = np.frombuffer(header, dtype=np.uint8)
+        buffer[-2:] = 0xff
+        buffer[row_offsets[:, None] + np.arange(2)] = np.frombuffer(struct.pack('>h', len(columns)), dtype=np.uint8)
+        field_offsets = row_offsets + 2
+        for lengths, payload in zip(field_lengths, payloads):
+            buffer[field_offsets[:, None] + np.arange(4)] = \
+                lengths.astype('>i4').view(np.uint8).reshape(row_count, 4)
+            # Scatters the payload bytes of non-null fields into place after their length prefix
+            payload_lengths = np.maximum(lengths, 0)
+            payload_starts = np.repeat(field_offsets + 4, payload_lengths)
+            within_field = np.arange(len(payload)) - np.repeat(np.cumsum(payload_lengths) - payload_lengths,
+                                                               payload_lengths)
+            buffer[payload_starts + within_field] = payload
+            field_offsets = field_offsets + 4 + payload_lengths
+        return buffer.tobytes()
+
+    def get_partitions(self):
+        # Lists the partitions of the table along with the bounds each one covers
+        get_partitions_command = "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i " \
+                                 "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent " \
+                                 f"WHERE p.relname = '{self.table_name}' ORDER BY c.relname"
+        self.cursor.execute(get_partitions_command)
+        return pd.DataFrame(self.cursor.fetchall(), columns=['partition', 'bounds'])
+
+    def drop_partition(self, partition_name):
+        # Dropping a whole partition removes its rows without a large DELETE
+        self.cursor.execute(f"DROP TABLE {partition_name}")
+        print(f'Partition "{partition_name}" successfully dropped from "{self.table_name}"')
+
+    def _ensure_partitions(self, data):
+        partition_info_command = "SELECT p.partstrat, a.attname, obj_description(c.oid, 'pg_class') " \
+                                 "FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid " \
+                                 "JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = p.partattrs[0] " \
+                                 f"WHERE c.relname = '{self.table_name}'"
+        self.cursor.execute(partition_info_command)
+        partition_info = self.cursor.fetchone()
+        # Hash partitions are all created with the table, so only range and list tables need new partitions
+        if partition_info is None or partition_info[0] == 'h' or partition_info[1] not in data.columns:
+            return
+        strategy, partition_column, comment = partition_info
+        values = data[partition_column].dropna().unique()
+        partitions = {}
+        # Rows with no partition key fall outside every bound, so they get a partition of their own
+        if data[partition_column].isna().any():
+            if strategy == 'l':
+                partitions[f"{self.table_name}_null_values"] = "FOR VALUES IN (NULL)"
+            else:
+                partitions[f"{self.table_name}_default"] = "DEFAULT"
+        if strategy == 'l':
+            for value in values:
+                name = ''.join(char if char.isalnum() else '_' for char in str(value)).lower()
+                partitions[f"{self.table_name}_{name}"] = f"FOR VALUES IN ({self._sql_literal(value)})"
+        else:
+            interval = comment.split('=')[1] if comment and comment.startswith('partition_interval=') else 'month'
+            if interval in self.partition_frequencies:
+                periods = pd.to_datetime(pd.Series(values)).dt.to_period(self.partition_frequencies[interval])
+                for period in periods.unique():
+                    start = period.start_time.date()
+                    end = (period + 1).start_time.date()
+                    partitions[f"{self.table_name}_{start:%Y%m%d}"] = f"FOR VALUES FROM ('{start}') TO ('{end}')"
+            else:
+                width = float(interval)
+                for start in np.unique(np.floor(values.astype(float) / width) * width):
+                    end = start + width
+                    if width.is_integer():
+                        start, end = int(start), int(end)
+                    name = str(start).replace('-', 'm').replace('.', '_')
+                    partitions[f"{self.table_name}_{name}"] = f"FOR VALUES FROM ({start}) TO ({end})"
+        for partition_name, bounds in partitions.items():
+            self.cursor.execute(f"CREATE TABLE IF NOT EXISTS {partition_name} PARTITION OF {self.table_name} {bounds}")
+
+    @staticmethod
+    def _sql_literal(value):
+        if isinstance(value, (int, float, np.integer, np.floating)):
+            return str(value)
+        return "'" + str(value).replace("'", "''") + "'"
+
+    def query(self, conditions=None, order=None, row_number=None, columns=None, group_by=None, aggregates=None,
+              distinct=False, sample=None, sample_method='system', seed=None, compact=False, workers=None, key=None):
+        if workers is not None and workers > 1:
+            # Ranges can only be merged back together when each row of the result comes from a single table row
+            if group_by is not None or aggregates is not None or distinct or sample is not None:
+                raise ValueError('Parallel queries only support conditions, order, row_number and columns')
+            df = self._parallel_query(conditions, order, row_number, columns, workers, key)
+            return self.compact_frame(df) if compact else df
+        query_command = self._build_query(conditions, order, row_number, columns, group_by, aggregates, distinct,
+                                          sample, sample_method, seed)
+        start = time.perf_counter()
+        self.cursor.execute(query_command)
+        result = self.cursor.fetchall()
+        # Column names are read from the cursor so projections and aliases are labelled correctly
+        result_columns = [description[0] for description in self.cursor.description]
+        self._capture_slow_query(query_command, time.perf_counter() - start)
+        df = pd.DataFrame(result, columns=result_columns)
+        if compact:
+            df = self.compact_frame(df)
+        return df
+
+    def _parallel_query(self, conditions, order, row_number, columns, workers, key=None):
+        by, ascending, nulls_first = self._order_columns(order) if order is not None else ([], [], [])
+        # Text order depends on the database collation, which pandas cannot reproduce when merging the ranges
+        column_types = self.get_column_types()
+        unmergeable = [column for column in by if not self._is_mergeable_type(column_types.get(column))]
+        if len(unmergeable) > 0:
+            raise ValueError(f'Parallel queries can only be ordered by numeric, boolean or date columns, '
+                             f'not {", ".join(unmergeable)}')
+        selected = columns
+        if columns is not None:
+            columns = [columns] if type(columns) == str else list(columns)
+            # Ordering columns are fetched even when not requested so the ranges can be merged in order
+            selected = columns + [column for column in by if column not in columns]
+        condition = None
+        if conditions is not None and len(conditions) > 0:
+            condition = " OR ".join(f"( {condition} )" for condition in conditions)
+
+        def read_range(cursor, index, range_condition):
+            range_conditions = [range_condition if condition is None else f"{range_condition} AND ( {condition} )"]
+            cursor.execute(self._build_query(range_conditions, order, row_number, selected))
+            return pd.DataFrame(cursor.fetchall(), columns=[description[0] for description in cursor.description])
+
+        frames = run_in_snapshot(self._read_ranges(workers * 4, key), read_range, workers)
+        df = pd.concat(frames, ignore_index=True)
+        # Each range is already sorted by Postgres, so a stable sort of the combined ranges only has to merge them.
+        # A null flag is sorted ahead of each column to place NULLs as Postgres does, last for ASC and first for DESC
+        if order is not None:
+            keys, directions, flags = [], [], []
+            for column, column_ascending, column_nulls_first in zip(by, ascending, nulls_first):
+                flag = f'_{column}_is_null'
+                df[flag] = df[column].isna()
+                keys += [flag, column]
+                directions += [not column_nulls_first, column_ascending]
+                flags.append(flag)
+            df = df.sort_values(keys, ascending=directions, kind='stable', ignore_index=True).drop(columns=flags)
+        if row_number is not None:
+            df = df.head(int(row_number))
+        return df[columns] if columns is not None else df
+
+    @staticmethod
+    def _order_columns(order):
+        # Splits an order such as "overall DESC, pace ASC NULLS FIRST" into its columns, whether each is ascending
+        # and whether its NULLs come first, which by default in Postgres they do only for descending columns
+        by, ascending, nulls_first = [], [], []
+        for item in order.split(','):
+            words = item.upper().split()
+            by.append(item.split()[0])
+            ascending.append(not (len(words) > 1 and words[1] == 'DESC'))
+            if 'NULLS' in words[:-1]:
+                nulls_first.append(words[words.index('NULLS') + 1] == 'FIRST')
+            else:
+                nulls_first.append(not ascending[-1])
+        return by, ascending, nulls_first
+
+    def _is_mergeable_type(self, sql_type):
+        return sql_type is not None and (sql_type in self.integer_ranges or sql_type.startswith('timestamp') or
+                                         sql_type in ('real', 'double precision', 'numeric', 'boolean', 'date'))
+
+    def _read_ranges(self, parts, key=None):
+        # Splits the table on a whole number key, by default the primary key, or on page ranges of ctid without one
+        column_types = self.get_column_types()
+        candidates = [key] if key is not None else self.get_primary_key()
+        if len(candidates) == 1 and column_types.get(candidates[0]) in self.integer_ranges:
+            key = candidates[0]
+            self.cursor.execute(f"SELECT MIN({key}), MAX({key}) FROM {self.table_name}")
+            lowest, highest = self.cursor.fetchone()
+            if lowest is None:
+                return ["TRUE"]
+            width = max(-(-(highest - lowest + 1) // parts), 1)
+            bounds = list(range(lowest + width, highest + 1, width))
+        else:
+            key = "ctid"
+            self.cursor.execute(f"SELECT pg_relation_size('{self.table_name}') / "
+                                "current_setting('block_size')::int")
+            pages = self.cursor.fetchone()[0]
+            width = max(-(-pages // parts), 1)
+            bounds = [f"'({page},0)'::tid" for page in range(width, pages, width)]
+        if len(bounds) == 0:
+            return ["TRUE"]
+        # The first and last ranges are open ended so rows added after the bounds were read are still covered
+        ranges = [f"{key} < {bounds[0]}"]
+        ranges += [f"{key} >= {lower} AND {key} < {upper}" for lower, upper in zip(bounds, bounds[1:])]
+        ranges.append(f"{key} >= {bounds[-1]}")
+        return ranges
+
+    def compact_frame(self, df, category_ratio=0.5):
+        # Gives each column the smallest dtype that fits, using the table's column types rather than guessing
+        column_types = self.get_column_types()
+        before = df.memory_usage(deep=True).sum()
+        # Arrow-backed strings are much smaller than Python string objects but need pyarrow to be installed
+        text_dtype = 'string[pyarrow]' if importlib.util.find_spec('pyarrow') is not None else 'string'
+        for column in df.columns:
+            column_type = column_types.get(column)
+            # Aliased expressions such as aggregates have no table type and are left as they are
+            if column_type is None or len(df) == 0 or df[column].isna().all():
+                continue
+            if column_type in self.integer_ranges:
+                numbers = pd.to_numeric(df[column])
+                for dtype in ('int8', 'int16', 'int32', 'int64'):
+                    if np.iinfo(dtype).min <= numbers.min() and numbers.max() <= np.iinfo(dtype).max:
+                        break
+                # Nullable integer types keep missing values without falling back to floats
+                df[column] = numbers.astype(dtype.capitalize() if numbers.isna().any() else dtype)
+            elif column_type == 'real':
+                df[column] = pd.to_numeric(df[column]).astype('float32')
+            elif column_type in ('double precision', 'numeric'):
+                # Double precision values would lose digits as float32, but numeric still shrinks from Decimal objects
+                df[column] = pd.to_numeric(df[column]).astype('float64')
+            elif column_type == 'boolean':
+                df[column] = df[column].astype('boolean')
+            elif column_type == 'date' or column_type.startswith('timestamp'):
+                df[column] = pd.to_datetime(df[column])
+            elif self._is_text_type(column_type):
+                # Columns that repeat a few values, like nationality or preferred_foot, are stored as categories
+                if df[column].nunique() <= len(df) * category_ratio:
+                    df[column] = df[column].astype('category')
+                else:
+                    df[column] = df[column].astype(text_dtype)
+        after = df.memory_usage(deep=True).sum()
+        saved = (1 - after / before) * 100 if before > 0 else 0
+        print(f'Result reduced from {before / 1e6:.2f} MB to {after / 1e6:.2f} MB ({saved:.0f}% smaller)')
+        return df
+
+    def preview(self, rows=100, sample_method='system', seed=None, columns=None):
+        # Uses the planner's row estimate to sample just enough of the table, so the cost does not grow with its size
+        self.cursor.execute(f"SELECT reltuples FROM pg_class WHERE oid = '{self.table_name}'::regclass")
+        estimate = self.cursor.fetchone()[0]
+        percent = 100 if estimate <= 0 else min(100.0, rows * 2 / estimate * 100)
+        while True:
+            df = self.query(columns=columns, row_number=rows, sample=percent, sample_method=sample_method, seed=seed)
+            # Page sampling can come up short on small or sparse tables, so the percentage is raised until it fills
+            if len(df) >= rows or percent >= 100:
+                return df
+            percent = min(100.0, percent * 10)
+
+    def create_search_index(self, columns, method='fulltext', language='english', vector_column='search_vector'):
+        if type(columns) == str:
+            columns = [columns]
+        if method == 'fulltext':
+            # Postgres keeps the generated tsvector up to date itself, so inserts and updates need no extra work
+            document = " || ' ' || ".join(f"coalesce({column}::text, '')" for column in columns)
+            self.cursor.execute(f"ALTER TABLE {self.table_name} ADD COLUMN IF NOT EXISTS {vector_column} tsvector "
+                                f"GENERATED ALWAYS AS (to_tsvector('{language}', {document})) STORED")
+            self.cursor.execute(f"CREATE INDEX IF NOT EXISTS {self.table_name}_{vector_column}_idx "
+                                f"ON {self.table_name} USING GIN ({vector_column})")
+        elif method == 'trigram':
+            # Trigram indexes serve fuzzy matches as well as ILIKE patterns with leading wildcards
+            self.cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            for column in columns:
+                self.cursor.execute(f"CREATE INDEX IF NOT EXISTS {self.table_name}_{column}_trgm_idx "
+                                    f"ON {self.table_name} USING GIN ({column} gin_trgm_ops)")
+        else:
+            raise ValueError(f'Unknown search index method "{method}", use fulltext or trigram')
+        print(f'{method.capitalize()} search index created on {", ".join(columns)} of "{self.table_name}"')
+
+    def search_methods(self, vector_column='search_vector'):
+        # Full-text search needs the generated search vector, fuzzy search needs the pg_trgm extension
+        methods = ['fulltext'] if vector_column in self.get_columns() else []
+        self.cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if self.cursor.fetchone() is not None:
+            methods.append('trigram')
+        return methods
+
+    def search(self, text, columns=None, fuzzy=False, prefix=False, limit=20, similarity=0.3, language='english',
+               vector_column='search_vector', result_columns=None):
+        methods = self.search_methods(vector_column)
+        if not fuzzy and 'fulltext' not in methods:
+            raise ValueError(f'"{self.table_name}" has no {vector_column} column - build a full-text search index '
+                             f'first or search with fuzzy matching')
+        if fuzzy and 'trigram' not in methods:
+            raise ValueError('fuzzy matching needs the pg_trgm extension - build a trigram search index first')
+        # The search vector itself is left out of the results unless asked for
+        selected = ", ".join(result_columns or [column for column in self.get_columns() if column != vector_column])
+        if not fuzzy:
+            # Every word must match, and with prefix each word also matches longer words it starts
+            terms = [''.join(char for char in word if char.isalnum()) for word in text.split()]
+            terms = [term + (':*' if prefix else '') for term in terms if term]
+            if len(terms) == 0:
+                print('No words to search for')
+                return pd.DataFrame()
+            search_command = self.cursor.mogrify(
+                f"SELECT {selected}, ts_rank({vector_column}, search_query) AS rank "
+                f"FROM {self.table_name}, to_tsquery('{language}', %s) AS search_query "
+                f"WHERE {vector_column} @@ search_query ORDER BY rank DESC LIMIT {int(limit)}",
+                (' & '.join(terms),)).decode()
+        else:
+            if columns is None:
+                columns = [column for column, column_type in self.get_column_types().items()
+                           if self._is_text_type(column_type)]
+            elif type(columns) == str:
+                columns = [columns]
+            # word_similarity compares the text with the closest part of each value, so single tags still score well
+            self.cursor.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, false)",
+                                (str(similarity),))
+            scores = ", ".join(self.cursor.mogrify(f"word_similarity(%s, {column})", (text,)).decode()
+                               for column in columns)
+            matches = [self.cursor.mogrify(f"%s <%% {column}", (text,)).decode() for column in columns]
+            if prefix:
+                pattern = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+                matches += [self.cursor.mogrify(f"{column} ILIKE %s", (pattern,)).decode() for column in columns]
+            rank = f"GREATEST({scores})" if len(columns) > 1 else scores
+            search_command = f"SELECT {selected}, {rank} AS rank FROM {self.table_name} " \
+                             f"{self._where_clause(matches)}ORDER BY rank DESC LIMIT {int(limit)}"
+        start = time.perf_counter()
+        self.cursor.execute(search_command)
+        result = self.cursor.fetchall()
+        result_columns = [description[0] for description in self.cursor.description]
+        self._capture_slow_query(search_command, time.perf_counter() - start)
+        return pd.DataFrame(result, columns=result_columns)
+
+    def profile(self, top_k=5, approximate=False, as_json=False):
+        # Search vectors are derived from other columns and have no meaningful min, max or frequent values
+        column_types = {column: column_type for column, column_type in self.get_column_types().items()
+                        if column_type != 'tsvector'}
+        if approximate:
+            profile = self._profile_from_stats(column_types)
+        else:
+            profile = self._profile_from_scan(column_types, top_k)
+        if profile is None:
+            return None
+        return profile.to_json(orient='index', default_handler=str) if as_json else profile
+
+    def _profile_from_scan(self, column_types, top_k):
+        columns = list(column_types)
+        # Null counts, min/max and text length histograms for every column are gathered in one aggregate scan
+        expressions = ["COUNT(*)"]
+        for i, column in enumerate(columns):
+            expressions.append(f"COUNT({column})")
+            if column_types[column] in ('boolean', 'bit'):
+                expressions += ["NULL", "NULL"]
             else:
-                query_command += conditions[0]
+                expressions += [f"MIN({column})::text", f"MAX({column})::text"]
+            if self._is_text_type(column_types[column]):
+                for lower, upper in zip(self.length_buckets, self.length_buckets[1:] + [None]):
+                    bucket_filter = f"LENGTH({column}) >= {lower}" + \
+                                    (f" AND LENGTH({column}) < {upper}" if upper is not None else "")
+                    expressions.append(f"COUNT(*) FILTER (WHERE {bucket_filter})")
+        self.cursor.execute(f"SELECT {', '.join(expressions)} FROM {self.table_name}")
+        stats = list(self.cursor.fetchone())
+        total_rows = stats.pop(0)
+        # Distinct counts and the most frequent values come from a second scan that unpivots every column
+        unpivot = ", ".join(f"('{column}', {column}::text)" for column in columns)
+        top_values_command = "SELECT column_name, value, frequency, distinct_values FROM (" \
+                             "SELECT column_name, value, frequency, " \
+                             "COUNT(value) OVER (PARTITION BY column_name) AS distinct_values, " \
+                             "ROW_NUMBER() OVER (PARTITION BY column_name ORDER BY frequency DESC) AS rank FROM (" \
+                             "SELECT unpivoted.column_name, unpivoted.value, COUNT(*) AS frequency " \
+                             f"FROM {self.table_name} CROSS JOIN LATERAL (VALUES {unpivot}) " \
+                             "AS unpivoted(column_name, value) WHERE unpivoted.value IS NOT NULL " \
+                             "GROUP BY unpivoted.column_name, unpivoted.value) AS counts) AS ranked " \
+                             f"WHERE rank <= {int(top_k)}"
+        self.cursor.execute(top_values_command)
+        top_values = {column: [] for column in columns}
+        distinct_values = {column: 0 for column in columns}
+        for column, value, frequency, distinct in self.cursor.fetchall():
+            top_values[column].append((value, frequency))
+            distinct_values[column] = distinct
+        rows = []
+        for column in columns:
+            non_null, minimum, maximum = stats[:3]
+            del stats[:3]
+            histogram = None
+            if self._is_text_type(column_types[column]):
+                labels = [f'{lower}+' if upper is None else f'{lower}-{upper - 1}'
+                          for lower, upper in zip(self.length_buckets, self.length_buckets[1:] + [None])]
+                histogram = dict(zip(labels, stats[:len(labels)]))
+                del stats[:len(labels)]
+            rows.append((column, column_types[column], 1 - non_null / total_rows if total_rows else None,
+                         distinct_values[column], minimum, maximum, top_values[column], histogram))
+        return pd.DataFrame(rows, columns=['column', 'type', 'null_fraction', 'distinct', 'min', 'max',
+                                           'top_values', 'length_histogram']).set_index('column')
+
+    def _profile_from_stats(self, column_types):
+        # pg_stats holds the sampled statistics gathered by ANALYZE, so reading it costs nothing
+        self.cursor.execute("SELECT reltuples FROM pg_class WHERE oid = %s::regclass", (self.table_name,))
+        estimated_rows = self.cursor.fetchone()[0]
+        stats_command = "SELECT attname, null_frac, n_distinct, most_common_vals::text::text[], most_common_freqs, " \
+                        "histogram_bounds::text::text[], avg_width FROM pg_stats WHERE tablename = %s"
+        self.cursor.execute(stats_command, (self.table_name,))
+        stats = {row[0]: row[1:] for row in self.cursor.fetchall()}
+        if len(stats) == 0:
+            print(f'No statistics are available for "{self.table_name}" yet - run ANALYZE or use a full profile')
+            return None
+        rows = []
+        for column, column_type in column_types.items():
+            if column not in stats:
+                continue
+            null_fraction, n_distinct, common_values, common_frequencies, bounds, average_width = stats[column]
+            # A negative n_distinct is a fraction of the row count rather than an absolute number
+            distinct = n_distinct if n_distinct >= 0 else -n_distinct * max(estimated_rows, 0)
+            top_values = [(value, round(frequency * max(estimated_rows, 0)))
+                          for value, frequency in zip(common_values or [], common_frequencies or [])]
+            rows.append((column, column_type, null_fraction, int(distinct), bounds[0] if bounds else None,
+                         bounds[-1] if bounds else None, top_values, average_width))
+        return pd.DataFrame(rows, columns=['column', 'type', 'null_fraction', 'distinct', 'min', 'max',
+                                           'top_values', 'average_width']).set_index('column')
+
+    @staticmethod
+    def _is_text_type(sql_type):
+        return sql_type.startswith('varchar') or sql_type in ('text', 'character varying', 'character')
+
+    def query_columnar(self, conditions=None, order=None, row_number=None, columns=None, group_by=None,
+                       aggregates=None, distinct=False, as_frame=True):
+        query_command = self._build_query(conditions, order, row_number, columns, group_by, aggregates, distinct)
+        # Reads the result's column types without fetching any rows
+        self.cursor.execute(f"SELECT * FROM ({query_command}) AS result LIMIT 0")
+        description = [(column.name, column.type_code) for column in self.cursor.description]
+        # numeric values such as AVG results are sent as float8 so they decode to floats rather than text
+        description = [(name, 701 if type_code == 1700 else type_code) for name, type_code in description]
+        fixed_list = []
+        text_names = []
+        for name, type_code in description:
+            if type_code in self.binary_result_formats:
+                value = f'"{name}"::float8' if type_code == 701 else f'"{name}"'
+                placeholder = {16: "false", 1082: "'2000-01-01'"}.get(type_code, "0")
+                # A null is sent as a placeholder value plus a flag, so the field keeps its fixed width
+                fixed_list += [f'COALESCE({value}, {placeholder})', f'"{name}" IS NULL']
+            else:
+                text_names.append(name)
+        # Other values are sent as text after the fixed-width fields, led by the row's total text bytes so the
+        # decoder can step from row to row without reading every field
+        text_list = []
+        if len(text_names) > 0:
+            text_list.append(' + '.join(f'COALESCE(octet_length("{name}"::text), 0)' for name in text_names))
+            text_list += [f'"{name}"::text' for name in text_names]
+        copy_command = f"COPY (SELECT {', '.join(fixed_list + text_list)} FROM ({query_command}) AS result) " \
+                       "TO STDOUT WITH (FORMAT binary)"
+        output = io.BytesIO()
+        start = time.perf_counter()
+        self.cursor.copy_expert(copy_command, output)
+        self._capture_slow_query(query_command, time.perf_counter() - start)
+        arrays = self._decode_binary_copy(output.getbuffer(), description)
+        if as_frame:
+            return pd.DataFrame(arrays, copy=False)
+        return arrays
+
+    def _decode_binary_copy(self, buffer, description):
+        data = np.frombuffer(buffer, dtype=np.uint8)
+        header_size = 19
+        body = data[header_size:max(len(data) - 2, header_size)]
+        fixed_columns = [(name, type_code) for name, type_code in description
+                         if type_code in self.binary_result_formats]
+        text_names = [name for name, type_code in description if type_code not in self.binary_result_formats]
+        # Works out where each fixed-width field starts within a row, after the row's field count
+        field_starts = {}
+        fixed_size = 2
+        for name, type_code in fixed_columns:
+            width = np.dtype(self.binary_result_formats[type_code]).itemsize
+            field_starts[name] = (fixed_size + 4, fixed_size + 4 + width + 4)
+            fixed_size += 4 + width + 4 + 1
+        if len(text_names) == 0:
+            # Every row has the same size, so the buffer is split into rows with one reshape
+            starts = None
+            rows = body.reshape(-1, fixed_size)
+        else:
+            # Rows differ in size only by their text, so the next row starts after this row's fixed part and its
+            # total text bytes. Only that one field is read per row, everything else is gathered in vectorised passes
+            read_total = struct.Struct('>i').unpack_from
+            view = memoryview(body)
+            row_base = fixed_size + 8 + 4 * len(text_names)
+            total_offset = fixed_size + 4
+            starts = []
+            add_start = starts.append
+            position = 0
+            end = len(body)
+            while position < end:
+                add_start(position)
+                position += row_base + read_total(view, position + total_offset)[0]
+            starts = np.array(starts, dtype=np.int64)
+            rows = body[starts[:, None] + np.arange(fixed_size)]
+        arrays = {}
+        for name, type_code in fixed_columns:
+            value_start, flag_start = field_starts[name]
+            width = np.dtype(self.binary_result_formats[type_code]).itemsize
+            nulls = rows[:, flag_start].astype(bool)
+            arrays[name] = self._decode_binary_column(rows[:, value_start:value_start + width], type_code, nulls)
+        if len(text_names) > 0:
+            field_offsets = starts + fixed_size + 8
+            for name in text_names:
+                lengths = body[field_offsets[:, None] + np.arange(4)].view('>i4')[:, 0].astype(np.int64)
+                sizes = np.maximum(lengths, 0)
+                # Gathers the bytes of every value in the column into one buffer, then slices each value out of it
+                value_starts = field_offsets + 4
+                ends = np.cumsum(sizes)
+                gathered = body[np.repeat(value_starts - (ends - sizes), sizes) + np.arange(int(sizes.sum()))]
+                gathered = gathered.tobytes()
+                begins = (ends - sizes).tolist()
+                text = np.empty(len(starts), dtype=object)
+                text[:] = [gathered[begin:end].decode('utf-8') for begin, end in zip(begins, ends.tolist())]
+                text[lengths < 0] = None
+                arrays[name] = text
+                field_offsets = value_starts + sizes
+        return {name: arrays[name] for name, _ in description}
+
+    def _decode_binary_column(self, raw, type_code, nulls):
+        # Reinterprets the raw big-endian bytes of one column as a native NumPy array
+        values = np.ascontiguousarray(raw).view(self.binary_result_formats[type_code])[:, 0]
+        if type_code == 1082:
+            values = np.datetime64('2000-01-01', 'D') + values.astype('timedelta64[D]')
+            values[nulls] = np.datetime64('NaT')
+            return values
+        if type_code == 16:
+            values = values.astype(bool)
+            if nulls.any():
+                values = np.where(nulls, None, values)
+            return values
+        values = values.astype(values.dtype.newbyteorder('='))
+        if nulls.any():
+            # Integer columns with nulls become floats so the nulls can be held as NaN
+            values = values.astype(np.float64)
+            values[nulls] = np.nan
+        return values
+
+    def explain(self, conditions=None, order=None, row_number=None, columns=None, group_by=None, aggregates=None,
+                distinct=False):
+        # Runs the query query() would run under EXPLAIN ANALYZE and returns one row per plan node
+        query_command = self._build_query(conditions, order, row_number, columns, group_by, aggregates, distinct)
+        return self.explain_statement(query_command)
+
+    def explain_statement(self, statement, analyze=True):
+        options = "ANALYZE, BUFFERS, FORMAT JSON" if analyze else "FORMAT JSON"
+        self.cursor.execute(f"EXPLAIN ({options}) {statement}")
+        plan = self.cursor.fetchone()[0][0]
+        nodes = pd.DataFrame(self._plan_nodes(plan['Plan']),
+                             columns=['node', 'node_type', 'relation', 'estimated_rows', 'actual_rows',
+                                      'estimate_error', 'shared_hit', 'shared_read', 'total_ms'])
+        if analyze:
+            # The raw node type is matched so nested and parallel sequential scans are both found
+            seq_scans = nodes.loc[nodes['node_type'].str.contains('Seq Scan'), 'relation'].tolist()
+            hits = nodes['shared_hit'].iloc[0] if len(nodes) > 0 else 0
+            reads = nodes['shared_read'].iloc[0] if len(nodes) > 0 else 0
+            print(f'Execution time: {plan["Execution Time"]:.2f}ms, planning time: {plan["Planning Time"]:.2f}ms')
+            print(f'Sequential scans: {", ".join(seq_scans) if seq_scans else "none"}')
+            print(f'Buffers: {hits} hit, {reads} read ({hits / max(hits + reads, 1) * 100:.1f}% from cache)')
+            worst = nodes['estimate_error'].max() if len(nodes) > 0 else 1
+            if worst >= 10:
+                print(f'Row estimates are off by up to {worst:.0f}x - running ANALYZE on the table may help')
+        return nodes
+
+    def _plan_nodes(self, node, depth=0):
+        # Flattens the nested plan, indenting node names so the tree shape is still visible
+        # Both row counts are per loop, so both are scaled by the loops to compare totals like for like
+        loops = node.get('Actual Loops', 1)
+        estimated = node.get('Plan Rows', 0) * loops
+        actual = node.get('Actual Rows', 0) * loops
+        error = max(estimated, 1) / max(actual, 1) if estimated > actual else max(actual, 1) / max(estimated, 1)
+        node_type = ('Parallel ' if node.get('Parallel Aware') else '') + node['Node Type']
+        rows = [('  ' * depth + node_type, node_type, node.get('Relation Name'), estimated,
+                 actual if 'Actual Rows' in node else None, error if 'Actual Rows' in node else None,
+                 node.get('Shared Hit Blocks'), node.get('Shared Read Blocks'), node.get('Actual Total Time'))]
+        for child in node.get('Plans', []):
+            rows += self._plan_nodes(child, depth + 1)
+        return rows
+
+    def _capture_slow_query(self, statement, seconds):
+        if self.slow_query_threshold is None or seconds < self.slow_query_threshold:
+            return
+        # The plan is taken without ANALYZE so a slow statement is not run a second time, and on its own cursor so
+        # the caller can still read the statement's result description afterwards
+        with self.connection.cursor() as explain_cursor:
+            explain_cursor.execute(f"EXPLAIN (FORMAT JSON) {statement}")
+            plan = explain_cursor.fetchone()[0]
+        entry = {'time': dt.datetime.now().isoformat(), 'table': self.table_name, 'seconds': round(seconds, 3),
+                 'statement': statement.strip(), 'plan': plan}
+        with open(self.slow_query_log, 'a') as log:
+            log.write(json.dumps(entry) + '\n')
+        print(f'Slow query ({seconds:.2f}s) logged to {self.slow_query_log}')
+
+    def _build_query(self, conditions=None, order=None, row_number=None, columns=None, group_by=None,
+                     aggregates=None, distinct=False, sample=None, sample_method='system', seed=None):
+        # Only the requested columns and aggregates are selected so Postgres does the work rather than pandas
+        select_list = []
+        if columns is not None:
+            if type(columns) == str:
+                columns = [columns]
+            select_list += columns
+        if group_by is not None and type(group_by) == str:
+            group_by = [group_by]
+        if aggregates is not None:
+            # Accepts either a single (function, column) pair or a list of them
+            if type(aggregates) == tuple:
+                aggregates = [aggregates]
+            for aggregate in aggregates:
+                if type(aggregate) == str:
+                    select_list.append(aggregate)
+                else:
+                    select_list.append(self.aggregate(*aggregate))
+        # Grouped columns must appear in the select list for the result to be meaningful, and SELECT * cannot be
+        # grouped, so a grouping on its own selects just the grouped columns
+        if group_by is not None and (aggregates is not None or columns is None):
+            select_list = [column for column in group_by if column not in select_list] + select_list
+        if len(select_list) == 0:
+            select_list = ['*']
+        query_command = "SELECT DISTINCT " if distinct else "SELECT "
+        query_command += f"{', '.join(select_list)} FROM {self.table_name} "
+        if sample is not None:
+            query_command += self._sample_clause(sample, sample_method, seed)
+        # If no row_number or conditions given, will return all rows by default
+        if conditions is not None and len(conditions) > 0:
+            query_command += self._where_clause(conditions)
+        if group_by is not None:
+            query_command += f"GROUP BY {', '.join(group_by)} "
         if order is not None:
             query_command += f"ORDER BY {order} "
         if row_number is not None:
             query_command += f"LIMIT {row_number} "
-        self.cursor.execute(query_command)
-        result = self.cursor.fetchall()
-        columns = self.get_columns()
-        df = pd.DataFrame(result, columns=columns)
-        return df
+        return query_command
+
+    @staticmethod
+    def _sample_clause(sample, sample_method='system', seed=None):
+        # Reads only a percentage of the table, SYSTEM picking whole pages and BERNOULLI individual rows
+        if sample_method.upper() not in ('SYSTEM', 'BERNOULLI'):
+            raise ValueError(f'{sample_method} is not a valid sampling method - use system or bernoulli')
+        sample_clause = f"TABLESAMPLE {sample_method.upper()} ({float(sample)}) "
+        if seed is not None:
+            sample_clause += f"REPEATABLE ({float(seed)}) "
+        return sample_clause
 
     def update_rows(self, columns, data, conditions=None):
         for i in range(len(columns)):
@@ -129,80 +1386,365 @@ class DatabaseConnection:
         print(f'Table renamed to "{new_table_name}"')
 
     def add_columns(self, new_columns, new_dtypes):
-        add_column_command = f"ALTER TABLE {self.table_name} ADD COLUMN "
         if type(new_columns) == str:
             new_columns = [new_columns]
         if type(new_dtypes) == str:
             new_dtypes = [new_dtypes]
-        if len(new_columns) > 1:
-            for i in range(len(new_columns) - 1):
-                add_column_command += f"{new_columns[i]} {new_dtypes[i]}, "
-            add_column_command += f"{new_columns[-1]} {new_dtypes[-1]})"
-        else:
-            add_column_command += f"{new_columns[0]} {new_dtypes[0]}"
-        self.cursor.execute(add_column_command)
-        print(f'New columns added to "{self.table_name}"')
+        self._apply_schema_changes(add=dict(zip(new_columns, new_dtypes)),
+                                   success_message=f'New columns added to "{self.table_name}"')
 
     def rename_columns(self, old_column_names, new_column_names):
         if type(old_column_names) == str:
             old_column_names = [old_column_names]
         if type(new_column_names) == str:
             new_column_names = [new_column_names]
-        if len(new_column_names) > 1:
-            for i in range(len(new_column_names) - 1):
-                # Skips rename if new column name same as previous one
-                if old_column_names[i] == new_column_names[i]:
-                    continue
-                else:
-                    rename_column_command = f"ALTER TABLE {self.table_name} RENAME COLUMN "
-                    rename_column_command += f"{old_column_names[i]} TO {new_column_names[i]}"
-                    self.cursor.execute(rename_column_command)
-            if old_column_names[-1] != new_column_names[-1]:
-                rename_column_command = f"ALTER TABLE {self.table_name} RENAME COLUMN "
-                rename_column_command += f"{old_column_names[-1]} TO {new_column_names[-1]}"
-                self.cursor.execute(rename_column_command)
-        else:
-            if old_column_names[0] != new_column_names[0]:
-                rename_column_command = f"ALTER TABLE {self.table_name} RENAME COLUMN "
-                rename_column_command += f"{old_column_names[0]} TO {new_column_names[0]}"
-                self.cursor.execute(rename_column_command)
-
-        print('Columns successfully renamed')
+        # Skips rename if new column name same as previous one
+        renames = {old: new for old, new in zip(old_column_names, new_column_names) if old != new}
+        self._apply_schema_changes(rename=renames, success_message='Columns successfully renamed')
 
     def drop_columns(self, column_names):
-        drop_column_command = f'ALTER TABLE {self.table_name} '
         if type(column_names) == str:
             column_names = [column_names]
-        if len(column_names) > 1:
-            for i in range(len(column_names) - 1):
-                drop_column_command += f"DROP COLUMN {column_names[i]}, "
-            drop_column_command += f"DROP COLUMN {column_names[-1]}"
-        else:
-            drop_column_command += f"DROP COLUMN{column_names[0]}"
-        self.cursor.execute(drop_column_command)
-        print(f'Columns successfully dropped from "{self.table_name}"')
+        self._apply_schema_changes(drop=column_names,
+                                   success_message=f'Columns successfully dropped from "{self.table_name}"')
+
+    def alter_columns(self, add=None, rename=None, drop=None, retype=None, lock_timeout='5s', dry_run=False):
+        # add and retype map column names to SQL types, rename maps old names to new ones and drop lists columns
+        return self._apply_schema_changes(add, rename, drop, retype, lock_timeout, dry_run,
+                                          f'Schema changes successfully applied to "{self.table_name}"')
+
+    def _apply_schema_changes(self, add=None, rename=None, drop=None, retype=None, lock_timeout='5s',
+                              dry_run=False, success_message=None):
+        add = add or {}
+        rename = rename or {}
+        drop = drop or []
+        retype = retype or {}
+        # Each operation is stored with whether Postgres would have to rewrite the whole table to apply it
+        operations = []
+        for column_name, dtype in add.items():
+            operations.append((f"ADD COLUMN {column_name} {dtype}", False))
+        for column_name in drop:
+            operations.append((f"DROP COLUMN {column_name}", False))
+        if len(retype) > 0:
+            current_types = self.get_column_types()
+            for column_name, dtype in retype.items():
+                rewrite = self._type_change_rewrites(current_types.get(column_name), dtype)
+                operations.append((f"ALTER COLUMN {column_name} TYPE {dtype} USING {column_name}::{dtype}", rewrite))
+        # RENAME cannot be combined with other subcommands so each gets its own statement in the transaction
+        renames = [f"RENAME COLUMN {old} TO {new}" for old, new in rename.items()]
+        if len(operations) == 0 and len(renames) == 0:
+            print('No schema changes given')
+            return []
+        if dry_run:
+            report = operations + [(operation, False) for operation in renames]
+            for operation, rewrite in report:
+                print(f'{operation} --> {"rewrites table" if rewrite else "metadata only"}')
+            return report
+        # Applies every change inside one transaction so the table is only locked once
+        self.connection.autocommit = False
+        try:
+            self.cursor.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+            if len(operations) > 0:
+                alter_command = f"ALTER TABLE {self.table_name} " + \
+                                ", ".join(operation for operation, rewrite in operations)
+                self.cursor.execute(alter_command)
+            for operation in renames:
+                self.cursor.execute(f"ALTER TABLE {self.table_name} {operation}")
+            self.connection.commit()
+        except psycopg2.Error as error:
+            self.connection.rollback()
+            print(f'Schema changes could not be applied, no changes were made: {error}')
+            return None
+        finally:
+            self.connection.autocommit = True
+        if success_message is not None:
+            print(success_message)
+        return [operation for operation, rewrite in operations] + renames
+
+    def migrate_column_type(self, column_name, new_type, batch_size=10000, key='id', pause=0, lock_timeout='5s'):
+        # Changes a column's type without rewriting the table under an exclusive lock
+        shadow_column = f"{column_name}_migrating"
+        sync_function = f"{self.table_name}_{column_name}_sync"
+        # Dropping the old column drops its constraints, default and indexes, so they are read first to rebuild them
+        self.cursor.execute("SELECT a.attnotnull, pg_get_expr(d.adbin, d.adrelid) FROM pg_attribute a "
+                            "LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum "
+                            "WHERE a.attrelid = %s::regclass AND a.attname = %s", (self.table_name, column_name))
+        not_null, default = self.cursor.fetchone()
+        self.cursor.execute("SELECT c.conname, c.contype, pg_get_constraintdef(c.oid), c.conindid FROM pg_constraint c "
+                            "JOIN pg_attribute a ON a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey) "
+                            "WHERE c.conrelid = %s::regclass AND a.attname = %s", (self.table_name, column_name))
+        constraints = self.cursor.fetchall()
+        self.cursor.execute("SELECT c.conname FROM pg_constraint c "
+                            "JOIN pg_attribute a ON a.attrelid = c.confrelid AND a.attnum = ANY(c.confkey) "
+                            "WHERE c.confrelid = %s::regclass AND a.attname = %s", (self.table_name, column_name))
+        referenced_by = [row[0] for row in self.cursor.fetchall()]
+        # Primary keys, foreign keys and exclusion constraints cannot be moved to a new column without blocking
+        blocking = [name for name, constraint_type, _, _ in constraints if constraint_type in ('p', 'f', 'x')]
+        if len(blocking) > 0 or len(referenced_by) > 0:
+            print(f'Column {column_name} is part of {", ".join(blocking + referenced_by)}, which cannot be moved '
+                  f'to a migrated column online - use alter_columns(retype=...) instead')
+            return
+        # Indexes on the column, including those behind unique constraints, are found through their dependencies
+        self.cursor.execute("SELECT DISTINCT i.relname, pg_get_indexdef(i.oid) FROM pg_depend d "
+                            "JOIN pg_class i ON i.oid = d.objid AND i.relkind = 'i' "
+                            "JOIN pg_attribute a ON a.attrelid = d.refobjid AND a.attnum = d.refobjsubid "
+                            "WHERE d.refobjid = %s::regclass AND a.attname = %s "
+                            "UNION SELECT i.relname, pg_get_indexdef(i.oid) FROM pg_class i WHERE i.oid = ANY(%s)",
+                            (self.table_name, column_name,
+                             [index_oid for _, constraint_type, _, index_oid in constraints if constraint_type == 'u']))
+        indexes = self.cursor.fetchall()
+        unique_constraints = {index_oid: name for name, constraint_type, _, index_oid in constraints
+                              if constraint_type == 'u'}
+        self.cursor.execute("SELECT relname, oid FROM pg_class WHERE relname = ANY(%s) AND relkind = 'i'",
+                            ([name for name, _ in indexes],))
+        index_oids = dict(self.cursor.fetchall())
+        checks = [(name, definition) for name, constraint_type, definition, _ in constraints if constraint_type == 'c']
+        if shadow_column in self.get_columns():
+            print(f'{shadow_column} is left over from an earlier migration - call abort_migration("{column_name}") '
+                  f'to remove it first')
+            return
+        # Adds a shadow column of the new type, which is a metadata-only change
+        if self._apply_schema_changes(add={shadow_column: new_type}, lock_timeout=lock_timeout) is None:
+            return
+        # A failed migration is undone straight away, otherwise the sync trigger would keep casting every write
+        try:
+            # Keeps the shadow column in step with any writes made while the backfill runs
+            self.cursor.execute(f"CREATE OR REPLACE FUNCTION {sync_function}() RETURNS trigger AS $$ "
+                                f"BEGIN NEW.{shadow_column} := NEW.{column_name}::{new_type}; RETURN NEW; END "
+                                f"$$ LANGUAGE plpgsql")
+            self.cursor.execute(f"CREATE TRIGGER {sync_function} BEFORE INSERT OR UPDATE ON {self.table_name} "
+                                f"FOR EACH ROW EXECUTE FUNCTION {sync_function}()")
+            # Backfills existing rows in key ranges, each range committed on its own under autocommit
+            self.cursor.execute(f"SELECT MIN({key}), MAX({key}) FROM {self.table_name}")
+            min_key, max_key = self.cursor.fetchone()
+            if min_key is not None:
+                backfilled = 0
+                start = min_key
+                while start <= max_key:
+                    self.cursor.execute(f"UPDATE {self.table_name} SET {shadow_column} = {column_name}::{new_type} "
+                                        f"WHERE {key} >= {start} AND {key} < {start + batch_size}")
+                    backfilled += self.cursor.rowcount
+                    start += batch_size
+                    print(f'{backfilled} rows backfilled ({min(start, max_key + 1) - min_key}/{max_key - min_key + 1} '
+                          f'of key range)')
+                    if pause > 0:
+                        time.sleep(pause)
+            if not_null:
+                # A validated check lets SET NOT NULL skip its full table scan while the swap holds its lock
+                self.cursor.execute(f"ALTER TABLE {self.table_name} ADD CONSTRAINT {shadow_column}_not_null "
+                                    f"CHECK ({shadow_column} IS NOT NULL) NOT VALID")
+                self.cursor.execute(f"ALTER TABLE {self.table_name} VALIDATE CONSTRAINT {shadow_column}_not_null")
+            # Each index is rebuilt on the shadow column concurrently, so writes carry on while it is built
+            shadow_indexes = []
+            for index_name, definition in indexes:
+                shadow_index = f"{index_name}_migrating"
+                prefix, rest = definition.split(' ON ', 1)
+                prefix = prefix.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1).rsplit(' ', 1)[0] + f' {shadow_index}'
+                # Only the part after USING names columns, so the table name is never rewritten
+                table_part, columns_part = rest.split(' USING ', 1)
+                columns_part = re.sub(rf'\b{re.escape(column_name)}\b', shadow_column, columns_part)
+                rest = f"{table_part} USING {columns_part}"
+                self.cursor.execute(f"{prefix} ON {rest}")
+                shadow_indexes.append((index_name, shadow_index, unique_constraints.get(index_oids.get(index_name))))
+            # Swaps the shadow column in within one short transaction, then puts back the old column's attributes
+            self.connection.autocommit = False
+            try:
+                self.cursor.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+                self.cursor.execute(f"DROP TRIGGER {sync_function} ON {self.table_name}")
+                self.cursor.execute(f"DROP FUNCTION {sync_function}()")
+                self.cursor.execute(f"ALTER TABLE {self.table_name} DROP COLUMN {column_name}")
+                self.cursor.execute(f"ALTER TABLE {self.table_name} RENAME COLUMN {shadow_column} TO {column_name}")
+                if default is not None:
+                    self.cursor.execute(f"ALTER TABLE {self.table_name} ALTER COLUMN {column_name} "
+                                        f"SET DEFAULT ({default})::{new_type}")
+                if not_null:
+                    self.cursor.execute(f"ALTER TABLE {self.table_name} ALTER COLUMN {column_name} SET NOT NULL")
+                    self.cursor.execute(f"ALTER TABLE {self.table_name} DROP CONSTRAINT {shadow_column}_not_null")
+                for index_name, shadow_index, constraint_name in shadow_indexes:
+                    if constraint_name is not None:
+                        self.cursor.execute(f"ALTER TABLE {self.table_name} ADD CONSTRAINT {constraint_name} "
+                                            f"UNIQUE USING INDEX {shadow_index}")
+                    else:
+                        self.cursor.execute(f"ALTER INDEX {shadow_index} RENAME TO {index_name}")
+                # Checks are added unvalidated so the swap does not scan the table while it holds its lock
+                for check_name, definition in checks:
+                    self.cursor.execute(f"ALTER TABLE {self.table_name} ADD CONSTRAINT {check_name} {definition} "
+                                        f"NOT VALID")
+                self.connection.commit()
+            except psycopg2.Error:
+                self.connection.rollback()
+                raise
+            finally:
+                self.connection.autocommit = True
+        except Exception as error:
+            print(f'Migration of {column_name} to {new_type} failed, undoing it: {error}')
+            self.abort_migration(column_name, lock_timeout)
+            return
+        for check_name, _ in checks:
+            self.cursor.execute(f"ALTER TABLE {self.table_name} VALIDATE CONSTRAINT {check_name}")
+        # Postgres cannot reorder columns, so the migrated column now comes last in SELECT * results
+        print(f'Column {column_name} successfully migrated to {new_type}')
+
+    def abort_migration(self, column_name, lock_timeout='5s'):
+        # Removes the sync trigger and shadow column of an unfinished migration, the shadow column's indexes and
+        # not-null check are dropped along with it
+        shadow_column = f"{column_name}_migrating"
+        sync_function = f"{self.table_name}_{column_name}_sync"
+        self.connection.autocommit = False
+        try:
+            self.cursor.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+            self.cursor.execute(f"DROP TRIGGER IF EXISTS {sync_function} ON {self.table_name}")
+            self.cursor.execute(f"DROP FUNCTION IF EXISTS {sync_function}()")
+            self.cursor.execute(f"ALTER TABLE {self.table_name} DROP COLUMN IF EXISTS {shadow_column}")
+            self.connection.commit()
+        except psycopg2.Error as error:
+            self.connection.rollback()
+            print(f'Migration of {column_name} could not be undone, call abort_migration again: {error}')
+            return False
+        finally:
+            self.connection.autocommit = True
+        print(f'Migration of {column_name} undone, the column keeps its original type')
+        return True
+
+    @staticmethod
+    def _type_change_rewrites(current_type, new_type):
+        # Widening a varchar or moving between varchar and text is binary compatible, anything else rewrites
+        if current_type is None:
+            return True
+        current_type = current_type.lower()
+        new_type = new_type.lower().replace(' ', '')
+        if current_type == new_type:
+            return False
+        if current_type.startswith('varchar') or current_type == 'text':
+            if new_type == 'text' or new_type == 'varchar':
+                return False
+            if new_type.startswith('varchar(') and current_type.startswith('varchar('):
+                return int(new_type[8:-1]) < int(current_type[8:-1])
+        return True
 
-    def delete_rows(self, conditions=None):
-        delete_row_command = f"DELETE FROM {self.table_name} "
+    def delete_rows(self, conditions=None, batch_size=None, key='id', pause=0):
         if conditions is None or len(conditions) == 0:
-            # Will delete all rows if no conditions given
-            self.cursor.execute(delete_row_command)
-        else:
-            delete_row_command += "WHERE "
-            if len(conditions) > 1:
-                for i in range(len(conditions) - 1):
-                    delete_row_command += f"{conditions[i]} OR "
-                delete_row_command += conditions[-1]
-            else:
-                delete_row_command += conditions[0]
-        self.cursor.execute(delete_row_command)
-        print('Rows successfully deleted')
+            # Will delete all rows if no conditions given - TRUNCATE avoids scanning and logging every row
+            self.cursor.execute(f"TRUNCATE TABLE {self.table_name}")
+            print('Rows successfully deleted')
+            return
+        where_clause = self._where_clause(conditions)
+        if batch_size is None:
+            self.cursor.execute(f"DELETE FROM {self.table_name} {where_clause}")
+            print('Rows successfully deleted')
+            return
+        # Counts matching rows up front so progress can be reported against a total
+        self.cursor.execute(f"SELECT COUNT(*) FROM {self.table_name} {where_clause}")
+        total = self.cursor.fetchone()[0]
+        # Deletes matching rows in key-ordered chunks, each committed on its own under autocommit
+        batch_command = f"DELETE FROM {self.table_name} WHERE {key} IN " \
+                        f"(SELECT {key} FROM {self.table_name} {where_clause}ORDER BY {key} LIMIT {int(batch_size)})"
+        deleted = 0
+        while True:
+            self.cursor.execute(batch_command)
+            if self.cursor.rowcount == 0:
+                break
+            deleted += self.cursor.rowcount
+            print(f'{deleted}/{total} rows deleted')
+            # Optional pause between batches to limit the load placed on the server
+            if pause > 0:
+                time.sleep(pause)
+        print(f'{deleted} rows successfully deleted')
+
+    def sync_csv(self, path, key='id', dry_run=False, batch_size=10000, pause=0):
+        # Makes the table match a fresh full copy of its CSV, applying only the rows added, changed or removed
+        with open(path, newline='') as file:
+            csv_columns = next(csv.reader(file))
+        table_columns = self.get_columns()
+        unknown_columns = [column for column in csv_columns if column not in table_columns]
+        if len(unknown_columns) > 0:
+            raise ValueError(f'The CSV has columns that are not in "{self.table_name}": {unknown_columns}')
+        # Generated columns, such as search vectors in a CSV written by save_table, are computed by Postgres and
+        # cannot be written, so only the CSV's other columns are compared and applied
+        self.cursor.execute("SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass AND attgenerated <> ''",
+                            (self.table_name,))
+        generated_columns = {row[0] for row in self.cursor.fetchall()}
+        columns = [column for column in csv_columns if column not in generated_columns]
+        if key not in columns:
+            raise ValueError(f'The CSV must contain the key column "{key}" to be synced')
+        staging = f"{self.table_name}_sync_staging"
+        changes = f"{self.table_name}_sync_changes"
+        self.cursor.execute(f"DROP TABLE IF EXISTS {staging}, {changes}")
+        # Staging copies the table's column types so both sides of the comparison are read the same way
+        self.cursor.execute(f"CREATE TEMP TABLE {staging} AS SELECT {', '.join(csv_columns)} "
+                            f"FROM {self.table_name} WITH NO DATA")
+        # COPY streams the file to the server in chunks rather than reading it all into memory
+        with open(path) as file:
+            self.cursor.copy_expert(f"COPY {staging} ({', '.join(csv_columns)}) FROM STDIN WITH CSV HEADER", file)
+        self.cursor.execute(f"CREATE INDEX ON {staging} ({key})")
+        self.cursor.execute(f"ANALYZE {staging}")
+        self.cursor.execute(f"SELECT {key} FROM {staging} GROUP BY {key} HAVING COUNT(*) > 1 LIMIT 5")
+        duplicates = [row[0] for row in self.cursor.fetchall()]
+        if len(duplicates) > 0:
+            self.cursor.execute(f"DROP TABLE {staging}")
+            raise ValueError(f'The CSV repeats values of "{key}", for example {duplicates}')
+        # Rows are compared by a digest of their text form, hashed by Postgres on both sides so values match exactly
+        digest = f"md5(ROW({', '.join(columns)})::text)"
+        self.cursor.execute(f"CREATE TEMP TABLE {changes} AS "
+                            f"SELECT COALESCE(incoming.{key}, existing.{key}) AS {key}, "
+                            f"CASE WHEN existing.{key} IS NULL THEN 'insert' "
+                            f"WHEN incoming.{key} IS NULL THEN 'delete' ELSE 'update' END AS action "
+                            f"FROM (SELECT {key}, {digest} AS digest FROM {staging}) AS incoming "
+                            f"FULL JOIN (SELECT {key}, {digest} AS digest FROM {self.table_name}) AS existing "
+                            f"ON incoming.{key} = existing.{key} "
+                            "WHERE incoming.digest IS DISTINCT FROM existing.digest")
+        self.cursor.execute(f"CREATE INDEX ON {changes} (action, {key})")
+        self.cursor.execute(f"SELECT action, COUNT(*) FROM {changes} GROUP BY action")
+        summary = {'insert': 0, 'update': 0, 'delete': 0}
+        summary.update(dict(self.cursor.fetchall()))
+        print(f'Syncing "{self.table_name}" with {path}: {summary["insert"]} rows to insert, '
+              f'{summary["update"]} to update and {summary["delete"]} to delete')
+        if not dry_run:
+            # Each batch takes its keys out of the change list, so an interrupted sync can simply be run again
+            batch = f"WITH batch AS (DELETE FROM {changes} WHERE {key} IN (SELECT {key} FROM {changes} " \
+                    f"WHERE action = %s LIMIT {int(batch_size)}) RETURNING {key}) "
+            assignments = ', '.join(f"{column} = incoming.{column}" for column in columns if column != key)
+            commands = {
+                'delete': f"DELETE FROM {self.table_name} WHERE {key} IN (SELECT {key} FROM batch)",
+                'update': f"UPDATE {self.table_name} SET {assignments} FROM {staging} AS incoming "
+                          f"WHERE {self.table_name}.{key} = incoming.{key} "
+                          f"AND incoming.{key} IN (SELECT {key} FROM batch)",
+                'insert': f"INSERT INTO {self.table_name} ({', '.join(columns)}) SELECT {', '.join(columns)} "
+                          f"FROM {staging} WHERE {key} IN (SELECT {key} FROM batch)",
+            }
+            for action, command in commands.items():
+                if action == 'update' and assignments == '':
+                    continue
+                applied = 0
+                while applied < summary[action]:
+                    self.cursor.execute(batch + command, (action,))
+                    if self.cursor.rowcount == 0:
+                        break
+                    applied += self.cursor.rowcount
+                    print(f'{applied}/{summary[action]} rows {action.rstrip("e")}ed')
+                    if pause > 0:
+                        time.sleep(pause)
+            # Inserted rows bring their own key values, so serial sequences are moved past them for later inserts
+            for column in columns if summary['insert'] > 0 else []:
+                self.cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", (self.table_name, column))
+                sequence = self.cursor.fetchone()[0]
+                if sequence is not None:
+                    self.cursor.execute(f"SELECT setval(%s, MAX({column})) FROM {self.table_name} "
+                                        f"HAVING MAX({column}) IS NOT NULL", (sequence,))
+            print(f'Table "{self.table_name}" is now in sync with {path}')
+        self.cursor.execute(f"DROP TABLE IF EXISTS {staging}, {changes}")
+        return summary
 
     def drop_table(self):
         drop_table_command = f"DROP TABLE {self.table_name}"
         self.cursor.execute(drop_table_command)
         print(f'Table "{self.table_name}" successfully dropped')
 
+    @staticmethod
+    def _where_clause(conditions):
+        # Joins each condition with OR to build the WHERE clause used by the row-level commands
+        return "WHERE " + " OR ".join(f"( {condition} )" for condition in conditions) + " "
+
     def get_columns(self):
         get_columns_command = "SELECT column_name, ordinal_position FROM information_schema.columns" \
                               f" WHERE table_name = '{self.table_name}' ORDER BY ordinal_position ASC"
@@ -212,18 +1754,219 @@ class DatabaseConnection:
                    for i in range(len(column_positions))]
         return columns
 
-    def save_table(self, path):
+    def get_primary_key(self):
+        get_primary_key_command = "SELECT a.attname FROM pg_index i JOIN pg_attribute a " \
+                                  "ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) " \
+                                  f"WHERE i.indrelid = '{self.table_name}'::regclass AND i.indisprimary"
+        self.cursor.execute(get_primary_key_command)
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def get_column_types(self):
+        # Maps each column name to its SQL type, including the length of varchar columns
+        get_types_command = "SELECT column_name, data_type, character_maximum_length FROM information_schema.columns" \
+                            f" WHERE table_name = '{self.table_name}' ORDER BY ordinal_position ASC"
+        self.cursor.execute(get_types_command)
+        column_types = {}
+        for column_name, data_type, max_length in self.cursor.fetchall():
+            if data_type == 'character varying':
+                data_type = f'varchar({max_length})' if max_length is not None else 'varchar'
+            column_types[column_name] = data_type
+        return column_types
+
+    def save_table(self, path, chunk_size=None, key='id', workers=None):
+        if workers is not None and workers > 1:
+            self._save_table_in_parallel(path, workers, key)
+            return
+        if chunk_size is not None:
+            self._save_table_in_chunks(path, chunk_size, key)
+            return
         gather_command = f"SELECT * FROM {self.table_name}"
-        self.cursor.execute(gather_command)
+        self._with_retry(lambda: self.cursor.execute(gather_command))
         result = self.cursor.fetchall()
         columns = self.get_columns()
         data = pd.DataFrame(result, columns=columns)
         data.to_csv(path, index=False)
         print(f'SQL table {self.table_name} successfully saved')
 
+    def _save_table_in_chunks(self, path, chunk_size, key):
+        # Exports in key order, recording the last key and file size after each chunk so an interrupted export resumes
+        checkpoint_path = path + '.checkpoint'
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            print(f'Resuming export of {self.table_name} after {key} {checkpoint["last_key"]}')
+        else:
+            checkpoint = {'last_key': None, 'bytes': 0}
+        exported = 0
+        while True:
+            def export_chunk():
+                # Anything written after the last checkpoint belongs to an unfinished chunk and is discarded first
+                with open(path, 'ab') as file:
+                    file.truncate(checkpoint['bytes'])
+                after = "" if checkpoint['last_key'] is None else \
+                    self.cursor.mogrify(f"WHERE {key} > %s ", (checkpoint['last_key'],)).decode()
+                self.cursor.execute(f"SELECT MAX({key}), COUNT(*) FROM (SELECT {key} FROM {self.table_name} {after}"
+                                    f"ORDER BY {key} LIMIT {int(chunk_size)}) AS chunk")
+                last_key, rows = self.cursor.fetchone()
+                if rows == 0:
+                    return None, 0
+                upper = self.cursor.mogrify(f"{key} <= %s", (last_key,)).decode()
+                condition = f"{after}AND {upper}" if after else f"WHERE {upper}"
+                header = "HEADER" if checkpoint['bytes'] == 0 else ""
+                with open(path, 'a') as file:
+                    self.cursor.copy_expert(f"COPY (SELECT * FROM {self.table_name} {condition} ORDER BY {key}) "
+                                            f"TO STDOUT WITH CSV {header}", file)
+                return last_key, rows
+
+            last_key, rows = self._with_retry(export_chunk)
+            if rows == 0:
+                break
+            exported += rows
+            checkpoint = {'last_key': last_key, 'bytes': os.path.getsize(path)}
+            with open(checkpoint_path, 'w') as checkpoint_file:
+                json.dump(checkpoint, checkpoint_file, default=str)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        print(f'SQL table {self.table_name} successfully saved ({exported} rows written in this run)')
+
+    def _save_table_in_parallel(self, path, workers, key):
+        # Each range is copied to its own part file at the same time, then the parts are joined in range order
+        def export_range(cursor, index, range_condition):
+            part_path = f'{path}.part{index}'
+            header = "HEADER" if index == 0 else ""
+            with open(part_path, 'w') as file:
+                cursor.copy_expert(f"COPY (SELECT * FROM {self.table_name} WHERE {range_condition}) "
+                                   f"TO STDOUT WITH CSV {header}", file)
+            return part_path
+
+        part_paths = run_in_snapshot(self._read_ranges(workers * 4, key), export_range, workers)
+        with open(path, 'wb') as file:
+            for part_path in part_paths:
+                with open(part_path, 'rb') as part:
+                    shutil.copyfileobj(part, file)
+                os.remove(part_path)
+        print(f'SQL table {self.table_name} successfully saved using {workers} connections')
+
+    def enable_change_tracking(self, watermark_column='updated_at', key='id'):
+        # Stamps every insert and update with the time it happened and records the key of every deleted row
+        self.cursor.execute(f"ALTER TABLE {self.table_name} ADD COLUMN IF NOT EXISTS {watermark_column} "
+                            "timestamptz NOT NULL DEFAULT now()")
+        self.cursor.execute(f"CREATE INDEX IF NOT EXISTS {self.table_name}_{watermark_column}_idx "
+                            f"ON {self.table_name} ({watermark_column})")
+        self.cursor.execute(f"CREATE OR REPLACE FUNCTION {self.table_name}_touch() RETURNS trigger AS $$ "
+                            f"BEGIN NEW.{watermark_column} := now(); RETURN NEW; END $$ LANGUAGE plpgsql")
+        self.cursor.execute(f"DROP TRIGGER IF EXISTS {self.table_name}_touch ON {self.table_name}")
+        self.cursor.execute(f"CREATE TRIGGER {self.table_name}_touch BEFORE UPDATE ON {self.table_name} "
+                            f"FOR EACH ROW EXECUTE FUNCTION {self.table_name}_touch()")
+        self.cursor.execute(f"CREATE TABLE IF NOT EXISTS {self.table_name}_deletions "
+                            f"(key text NOT NULL, deleted_at timestamptz NOT NULL DEFAULT now())")
+        self.cursor.execute(f"ALTER TABLE {self.table_name}_deletions "
+                            "ADD COLUMN IF NOT EXISTS operation text NOT NULL DEFAULT 'delete'")
+        self.cursor.execute(f"CREATE OR REPLACE FUNCTION {self.table_name}_log_deletion() RETURNS trigger AS $$ "
+                            f"BEGIN INSERT INTO {self.table_name}_deletions (key) VALUES (OLD.{key}::text); "
+                            "RETURN OLD; END $$ LANGUAGE plpgsql")
+        self.cursor.execute(f"DROP TRIGGER IF EXISTS {self.table_name}_log_deletion ON {self.table_name}")
+        self.cursor.execute(f"CREATE TRIGGER {self.table_name}_log_deletion AFTER DELETE ON {self.table_name} "
+                            f"FOR EACH ROW EXECUTE FUNCTION {self.table_name}_log_deletion()")
+        # TRUNCATE skips row triggers, so it is recorded as a single marker meaning every earlier row was removed
+        self.cursor.execute(f"CREATE OR REPLACE FUNCTION {self.table_name}_log_truncation() RETURNS trigger AS $$ "
+                            f"BEGIN INSERT INTO {self.table_name}_deletions (key, operation) VALUES ('*', 'truncate'); "
+                            "RETURN NULL; END $$ LANGUAGE plpgsql")
+        self.cursor.execute(f"DROP TRIGGER IF EXISTS {self.table_name}_log_truncation ON {self.table_name}")
+        self.cursor.execute(f"CREATE TRIGGER {self.table_name}_log_truncation AFTER TRUNCATE ON {self.table_name} "
+                            f"FOR EACH STATEMENT EXECUTE FUNCTION {self.table_name}_log_truncation()")
+        print(f'Change tracking enabled on "{self.table_name}" using column {watermark_column}')
+
+    def save_changes(self, path, watermark_column='updated_at', deletions_path=None, export_name='default',
+                     overlap='1 minute'):
+        # Writes only the rows added or changed since the last export, plus the keys deleted since then.
+        # An id column can be used as the watermark instead of updated_at, which picks up inserts only.
+        # Rows near the previous watermark may be written again, so consumers should upsert on the key. With an id
+        # watermark, rows since the last settled id are re-read while other transactions are open
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS export_watermarks (table_name text, export_name text, "
+                            "watermark text, deletions_watermark text, exported_at timestamptz, "
+                            "PRIMARY KEY (table_name, export_name))")
+        self.cursor.execute("ALTER TABLE export_watermarks ADD COLUMN IF NOT EXISTS pending_watermark text, "
+                            "ADD COLUMN IF NOT EXISTS pending_at timestamptz")
+        self.cursor.execute("SELECT watermark, deletions_watermark, pending_watermark, pending_at "
+                            "FROM export_watermarks WHERE table_name = %s AND export_name = %s",
+                            (self.table_name, export_name))
+        previous = self.cursor.fetchone() or (None, None, None, None)
+        self.cursor.execute("SELECT to_regclass(%s) IS NOT NULL", (f"{self.table_name}_deletions",))
+        deletions_logged = self.cursor.fetchone()[0]
+        time_watermark = self.get_column_types().get(watermark_column, '').startswith('timestamp')
+
+        # All reads come from one snapshot so the new watermarks match exactly what is written out
+        self.connection.autocommit = False
+        try:
+            self.cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            # updated_at holds when a transaction started, not when it committed, so a transaction still open now
+            # can commit rows older than anything visible. The watermark is held back to the oldest open transaction
+            self.cursor.execute("SELECT MIN(xact_start) FROM pg_stat_activity "
+                                "WHERE xact_start IS NOT NULL AND pid <> pg_backend_pid()")
+            oldest_open = self.cursor.fetchone()[0]
+            self.cursor.execute(f"SELECT MAX({watermark_column})::text, clock_timestamp() FROM {self.table_name}")
+            watermark, read_at = self.cursor.fetchone()
+            watermark = watermark or previous[0]
+            pending, pending_at = None, None
+            if time_watermark and watermark is not None and oldest_open is not None:
+                self.cursor.execute("SELECT LEAST(%s::timestamptz, %s)::text", (watermark, oldest_open))
+                watermark = self.cursor.fetchone()[0]
+            elif not time_watermark and oldest_open is not None:
+                # Ids are also taken before commit, so a transaction open now can still commit ids below the largest
+                # visible one. That id is kept as pending and only becomes the watermark once every transaction
+                # which was open when it was read has finished
+                settled = previous[2] is not None and oldest_open > previous[3]
+                if previous[2] is None or settled:
+                    pending, pending_at = watermark, read_at
+                else:
+                    pending, pending_at = previous[2], previous[3]
+                watermark = previous[2] if settled else previous[0]
+            changes_command = f"SELECT * FROM {self.table_name}"
+            if previous[0] is not None and time_watermark:
+                # Open transactions are not always visible in pg_stat_activity, so a short overlap is re-read as well
+                changes_command += self.cursor.mogrify(f" WHERE {watermark_column} >= %s::timestamptz - %s::interval",
+                                                       (previous[0], overlap)).decode()
+            elif previous[0] is not None:
+                changes_command += self.cursor.mogrify(f" WHERE {watermark_column} > %s", (previous[0],)).decode()
+            with open(path, 'w') as file:
+                self.cursor.copy_expert(f"COPY ({changes_command}) TO STDOUT WITH CSV HEADER", file)
+            changed_rows = self.cursor.rowcount
+            deletions_watermark = previous[1]
+            if deletions_logged and deletions_path is not None:
+                self.cursor.execute(f"SELECT LEAST(MAX(deleted_at), %s)::text FROM {self.table_name}_deletions",
+                                    (oldest_open,))
+                deletions_watermark = self.cursor.fetchone()[0] or previous[1]
+                # A truncate marker with key * means every row exported before it has been removed
+                deletions_command = f"SELECT key, deleted_at, operation FROM {self.table_name}_deletions"
+                if previous[1] is not None:
+                    deletions_command += self.cursor.mogrify(" WHERE deleted_at >= %s::timestamptz - %s::interval",
+                                                             (previous[1], overlap)).decode()
+                with open(deletions_path, 'w') as file:
+                    self.cursor.copy_expert(f"COPY ({deletions_command}) TO STDOUT WITH CSV HEADER", file)
+            self.cursor.execute("INSERT INTO export_watermarks (table_name, export_name, watermark, "
+                                "deletions_watermark, exported_at, pending_watermark, pending_at) "
+                                "VALUES (%s, %s, %s, %s, now(), %s, %s) "
+                                "ON CONFLICT (table_name, export_name) DO UPDATE SET watermark = EXCLUDED.watermark, "
+                                "deletions_watermark = EXCLUDED.deletions_watermark, exported_at = now(), "
+                                "pending_watermark = EXCLUDED.pending_watermark, pending_at = EXCLUDED.pending_at",
+                                (self.table_name, export_name, watermark, deletions_watermark, pending, pending_at))
+            self.connection.commit()
+        except (psycopg2.Error, OSError):
+            self.connection.rollback()
+            raise
+        finally:
+            self.connection.autocommit = True
+        print(f'{changed_rows} changed rows of {self.table_name} successfully saved')
+
     def close_connection(self):
-        self.cursor.close()
-        self.connection.close()
+        # Nothing to close if no statement was ever run
+        if self._connection is None:
+            return
+        self._cursor.close()
+        self._connection.close()
+        self._cursor = None
+        self._connection = None
         print('PostgreSQL connection is closed')
 
     @staticmethod
@@ -266,6 +2009,15 @@ class DatabaseConnection:
         condition = f" {column_name} IS NOT NULL "
         return condition
 
+    @staticmethod
+    def aggregate(function, column_name='*'):
+        # Produces an aggregate expression, aliased so the result column has a readable name
+        function = function.lower()
+        if function not in ('count', 'sum', 'avg', 'min', 'max'):
+            raise ValueError(f'{function} is not a supported aggregate function')
+        alias = f"{function}_all" if column_name == '*' else f"{function}_{column_name}"
+        return f"{function.upper()}({column_name}) AS {alias}"
+
     @staticmethod
     def asc(column_name):
         return f"{column_name} ASC"
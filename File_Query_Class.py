@@ -0,0 +1,96 @@
+import os
+
+from lazy import lazy_import
+from Database_Class import DatabaseConnection
+
+duckdb = lazy_import('duckdb')
+pd = lazy_import('pandas')
+
+
+class FileQueryConnection:
+    # Runs the same queries as DatabaseConnection directly on a CSV or Parquet file using an embedded DuckDB engine,
+    # so a file can be filtered or aggregated without a server or a load step
+    _build_query = DatabaseConnection._build_query
+    _where_clause = staticmethod(DatabaseConnection._where_clause)
+    # CSV columns are typed the way pandas reads them for create_table, as whole numbers, decimals, booleans or
+    # text, so dates stay text here just as they are stored as varchar in Postgres
+    file_readers = {'.csv': "read_csv('{}', auto_type_candidates=['BIGINT', 'DOUBLE', 'BOOLEAN', 'VARCHAR'])",
+                    '.parquet': "read_parquet('{}')"}
+
+    def __init__(self, path, table_name=None, file_format=None):
+        self.path = path
+        file_format = file_format or os.path.splitext(path)[1].lower()
+        file_format = file_format if file_format.startswith('.') else f'.{file_format}'
+        if file_format not in self.file_readers:
+            raise ValueError(f'{file_format} files are not supported - use a CSV or Parquet file')
+        self.file_format = file_format
+        # The file is exposed as a view so conditions and orders refer to it exactly as they would to a table
+        self.table_name = table_name or ''.join(char if char.isalnum() else '_'
+                                                for char in os.path.splitext(os.path.basename(path))[0])
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            if not os.path.exists(self.path):
+                raise FileNotFoundError(self.path)
+            self._connection = duckdb.connect()
+            escaped_path = self.path.replace("'", "''")
+            self._connection.execute(f"CREATE VIEW {self.table_name} AS "
+                                     f"SELECT * FROM {self.file_readers[self.file_format].format(escaped_path)}")
+            print(f'Opened "{self.path}" as "{self.table_name}"')
+        return self._connection
+
+    @staticmethod
+    def _sample_clause(sample, sample_method='system', seed=None):
+        # DuckDB writes the percentage and method differently to Postgres and only takes whole number seeds
+        if sample_method.upper() not in ('SYSTEM', 'BERNOULLI'):
+            raise ValueError(f'{sample_method} is not a valid sampling method - use system or bernoulli')
+        options = sample_method.lower() if seed is None else f"{sample_method.lower()}, {int(seed)}"
+        return f"TABLESAMPLE {float(sample)}% ({options}) "
+
+    def query(self, conditions=None, order=None, row_number=None, columns=None, group_by=None, aggregates=None,
+              distinct=False, sample=None, sample_method='system', seed=None):
+        query_command = self._build_query(conditions, order, row_number, columns, group_by, aggregates, distinct,
+                                          sample, sample_method, seed)
+        return self.connection.execute(query_command).df()
+
+    def preview(self, rows=100, sample_method='system', seed=None, columns=None):
+        # The file has no planner estimate to size a percentage from, so an exact number of rows is sampled instead.
+        # DuckDB only samples exact row counts with reservoir sampling, so the method is checked but not used
+        if sample_method.upper() not in ('SYSTEM', 'BERNOULLI'):
+            raise ValueError(f'{sample_method} is not a valid sampling method - use system or bernoulli')
+        seed_option = '' if seed is None else f', {int(seed)}'
+        selected = ', '.join([columns] if type(columns) == str else columns) if columns is not None else '*'
+        return self.connection.execute(f"SELECT {selected} FROM {self.table_name} "
+                                       f"USING SAMPLE {int(rows)} ROWS (reservoir{seed_option})").df()
+
+    def explain(self, conditions=None, order=None, row_number=None, columns=None, group_by=None, aggregates=None,
+                distinct=False):
+        query_command = self._build_query(conditions, order, row_number, columns, group_by, aggregates, distinct)
+        plan = self.connection.execute(f"EXPLAIN {query_command}").fetchall()
+        return pd.DataFrame(plan, columns=['plan_type', 'plan'])
+
+    def get_columns(self):
+        return [row[0] for row in self.connection.execute(f"DESCRIBE {self.table_name}").fetchall()]
+
+    def get_column_types(self):
+        return {row[0]: row[1] for row in self.connection.execute(f"DESCRIBE {self.table_name}").fetchall()}
+
+    def close_connection(self):
+        if self._connection is None:
+            return
+        self._connection.close()
+        self._connection = None
+        print(f'Closed "{self.path}"')
+
+    equal = staticmethod(DatabaseConnection.equal)
+    greater_than = staticmethod(DatabaseConnection.greater_than)
+    less_than = staticmethod(DatabaseConnection.less_than)
+    between = staticmethod(DatabaseConnection.between)
+    not_equal = staticmethod(DatabaseConnection.not_equal)
+    is_null = staticmethod(DatabaseConnection.is_null)
+    not_null = staticmethod(DatabaseConnection.not_null)
+    aggregate = staticmethod(DatabaseConnection.aggregate)
+    asc = staticmethod(DatabaseConnection.asc)
+    desc = staticmethod(DatabaseConnection.desc)
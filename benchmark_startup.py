@@ -0,0 +1,52 @@
+"""
+Measures the cold start time of the terminal and GUI front-ends in fresh
+interpreters and fails if either exceeds the target.
+"""
+import os
+import sys
+import time
+import subprocess
+
+TARGET_SECONDS = 0.5
+HEAVY_MODULES = ('pandas', 'numpy', 'psycopg2')
+
+CLI_STARTUP = 'import terminal'
+# Opening and drawing the window needs a display, so only the import is measured without one
+GUI_STARTUP = 'import interface, tkinter as tk; root = tk.Tk(); root.update(); root.destroy()' \
+    if os.environ.get('DISPLAY') or sys.platform in ('win32', 'darwin') else 'import interface'
+
+
+def time_statement(statement, repeats=5):
+    # Takes the fastest of several runs so one-off disk or scheduler delays are ignored
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', statement], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def heavy_imports(statement):
+    # Lists which heavy modules were imported at start-up, which should be none of them
+    check = f"{statement}; import sys; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', check], check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return result.stdout.strip().splitlines()[-1] if result.stdout.strip() else ''
+
+
+def run():
+    # Interpreter start-up is measured separately so only the program's own cost is compared to the target
+    baseline = time_statement('pass')
+    passed = True
+    for name, statement in (('CLI', CLI_STARTUP), ('GUI', GUI_STARTUP)):
+        startup = time_statement(statement) - baseline
+        loaded = heavy_imports(statement)
+        within_target = startup <= TARGET_SECONDS
+        passed = passed and within_target
+        print(f'{name} start-up: {startup * 1000:.0f}ms (target {TARGET_SECONDS * 1000:.0f}ms) '
+              f'{"OK" if within_target else "TOO SLOW"}, heavy modules loaded: {loaded or "none"}')
+    return passed
+
+
+if __name__ == '__main__':
+    sys.exit(0 if run() else 1)
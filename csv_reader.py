@@ -0,0 +1,86 @@
+"""
+Parallel CSV reader which memory-maps the input file, splits it into row-aligned
+segments and parses each segment in its own worker process.
+"""
+import io
+import os
+import mmap
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+QUOTE = ord('"')
+NEWLINE = ord('\n')
+
+
+def find_row_boundary(data, position, quotes_before):
+    # Returns the offset just after the first newline at or after position that is not inside a quoted field
+    window = 1 << 16
+    while position < len(data):
+        chunk = data[position:position + window]
+        # A newline ends a row when an even number of quotes has been seen since the start of the file
+        quote_parity = (quotes_before + np.cumsum(chunk == QUOTE)) % 2
+        row_ends = np.flatnonzero((chunk == NEWLINE) & (quote_parity == 0))
+        if len(row_ends) > 0:
+            return position + int(row_ends[0]) + 1
+        quotes_before += int(np.count_nonzero(chunk == QUOTE))
+        position += len(chunk)
+    return len(data)
+
+
+def segment_csv(path, segments):
+    # Splits the file body into (start, end) byte ranges that each begin and end on a row boundary
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return b'', []
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            data = np.frombuffer(mapped, dtype=np.uint8)
+            header_end = find_row_boundary(data, 0, 0)
+            header = bytes(mapped[:header_end])
+            body_size = len(data) - header_end
+            boundaries = [header_end]
+            counted_until = 0
+            quotes_before = 0
+            for i in range(1, segments):
+                target = header_end + body_size * i // segments
+                if target <= boundaries[-1]:
+                    continue
+                # Quotes before the target decide whether a newline after it is inside a quoted field
+                quotes_before += int(np.count_nonzero(data[counted_until:target] == QUOTE))
+                counted_until = target
+                boundary = find_row_boundary(data, target, quotes_before)
+                if boundary > boundaries[-1] and boundary < len(data):
+                    boundaries.append(boundary)
+            boundaries.append(len(data))
+            del data
+    return header, list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def parse_segment(path, header, start, end):
+    # Runs in a worker process: reads its own byte range through mmap and parses it with the header prepended
+    with open(path, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            segment = mapped[start:end]
+    return pd.read_csv(io.BytesIO(header + segment))
+
+
+def read_csv_parallel(path, workers=None, segments=None, progress=None, with_offsets=False):
+    # Yields DataFrames in file order as soon as each segment is parsed, so loading can begin before the whole file
+    # is read while later segments keep parsing in the background
+    workers = workers or os.cpu_count() or 1
+    header, ranges = segment_csv(path, segments or workers * 4)
+    if len(ranges) == 0:
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [(executor.submit(parse_segment, path, header, start, end), start, end) for start, end in ranges]
+        rows_before = 0
+        for future, start, end in futures:
+            data = future.result()
+            # Numbers each row from the rows in earlier segments, so the index is its data row in the whole file
+            data.index = pd.RangeIndex(rows_before, rows_before + len(data))
+            rows_before += len(data)
+            if progress is not None:
+                progress.update(bytes_read=end - start, rows_parsed=len(data))
+            # The starting byte offset identifies the segment, which lets interrupted loads skip finished segments
+            yield (start, data) if with_offsets else data
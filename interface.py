@@ -1,11 +1,15 @@
 import os
-import pandas as pd
 import datetime as dt
 import tkinter as tk
 from tkinter import filedialog, ttk
 import tkinter.font as font
 
+from lazy import lazy_import
 from Database_Class import DatabaseConnection
+from progress import LoadProgress
+
+# pandas is only needed once a CSV file is read, so it is not imported before the window opens
+pd = lazy_import('pandas')
 
 
 def add_columns(table, column_names_str, column_dtypes_str):
@@ -140,21 +144,36 @@ def create_table(table, filepath, id_included, create_and_insert):
 
     # If the user wishes to insert data as well, the program is able to carry both these out
     if (create_and_insert):
-        database_connection.insert_rows(columns, data)
+        progress = create_progress_bar(os.path.getsize(filepath))
+        progress.update(bytes_read=progress.total_bytes, rows_parsed=len(data))
+        database_connection.insert_rows(columns, data, progress=progress)
+        progress.finish()
 
     database_connection.close_connection()
 
 
 def insert_data(table, filepath):
-    data = pd.read_csv(filepath)
-    data = data.copy()
-    columns = [column for column in data.columns]
-
     database_connection = DatabaseConnection(table)
-    database_connection.insert_rows(columns, data)
+    database_connection.insert_csv(filepath, progress=create_progress_bar())
     database_connection.close_connection()
 
 
+def create_progress_bar(total_bytes=None):
+    # Shows a progressbar under the current screen which is redrawn by the load's progress callback
+    progress_bar = ttk.Progressbar(root, orient='horizontal', length=400, mode='determinate', maximum=100)
+    progress_bar.grid(row=8, columnspan=2, pady=5)
+    progress_lbl = tk.Label(root, text='Starting load...', wraplength=430)
+    progress_lbl.grid(row=9, columnspan=2)
+
+    def show_progress(progress):
+        progress_bar['value'] = progress.fraction * 100
+        progress_lbl['text'] = progress.summary()
+        # The load runs on the main thread, so the window is refreshed here to keep it responsive
+        root.update()
+
+    return LoadProgress(total_bytes, callback=show_progress)
+
+
 def save_data(table, filepath):
     database_connection = DatabaseConnection(table)
     database_connection.save_table(filepath)
@@ -186,10 +205,26 @@ def query_data(table, frame, conditions=None, limit=None, order=None):
         limit_int = None
 
     database_connection = DatabaseConnection(table)
-    # Obtains query result as a DataFrame
-    df = database_connection.query(conditions, order, limit_int)
+    # Obtains query result as a DataFrame, or the plan's nodes if the user asked to explain the query
+    if explain_query.get():
+        df = database_connection.explain(conditions, order, limit_int)
+    else:
+        df = database_connection.query(conditions, order, limit_int)
     database_connection.close_connection()
 
+    display_results(df)
+
+
+def preview_data(table, rows=100):
+    database_connection = DatabaseConnection(table)
+    # Obtains a random sample of the table, which is fast however large the table is
+    df = database_connection.preview(rows)
+    database_connection.close_connection()
+
+    display_results(df)
+
+
+def display_results(df):
     for widget in root.winfo_children():
         widget.destroy()
 
@@ -742,6 +777,14 @@ def query(table):
     no_btn = tk.Button(query_frame, text='No', font=myFont, command=lambda: limit_creator(
         table, query_frame, None)).grid(row=2, column=1, pady=10)
 
+    sample_btn = tk.Button(root, text='Preview a random sample', font=myFont, command=lambda: preview_data(
+        table)).grid(row=6, columnspan=2, pady=10)
+
+    checkbox_explain = tk.Checkbutton(root, text='Tick this to see the query plan instead of results', font=myFont,
+                                      variable=explain_query, onvalue=True, offvalue=False)
+    checkbox_explain.grid(row=5, columnspan=2)
+    checkbox_explain.deselect()
+
 
 def update(table):
     for ele in root.winfo_children():
@@ -821,6 +864,7 @@ if __name__ == '__main__':
     myFont = font.Font(font='Helvetica 14')
 
     conditions = []
+    explain_query = tk.BooleanVar()
 
     root.columnconfigure(0, weight=1)
 
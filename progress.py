@@ -0,0 +1,79 @@
+"""
+Progress tracking for loads, shared by the terminal and GUI front-ends and
+available to programmatic callers through a callback.
+"""
+import sys
+import time
+import datetime as dt
+
+
+class LoadProgress:
+    def __init__(self, total_bytes=None, callback=None, interval=0.5):
+        self.total_bytes = total_bytes
+        self.bytes_read = 0
+        self.rows_parsed = 0
+        self.rows_committed = 0
+        self.finished = False
+        # The callback receives this object and is rate limited so reporting never slows the load down
+        self.callback = callback
+        self.interval = interval
+        self.start_time = time.perf_counter()
+        self.last_report = 0
+
+    def update(self, bytes_read=0, rows_parsed=0, rows_committed=0):
+        self.bytes_read += bytes_read
+        self.rows_parsed += rows_parsed
+        self.rows_committed += rows_committed
+        now = time.perf_counter()
+        if self.callback is not None and now - self.last_report >= self.interval:
+            self.last_report = now
+            self.callback(self)
+
+    def finish(self):
+        self.finished = True
+        if self.callback is not None:
+            self.callback(self)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    @property
+    def rows_per_second(self):
+        return self.rows_committed / self.elapsed if self.elapsed > 0 else 0
+
+    @property
+    def mb_per_second(self):
+        return self.bytes_read / 1e6 / self.elapsed if self.elapsed > 0 else 0
+
+    @property
+    def fraction(self):
+        # Share of the file read, scaled by how many of the parsed rows have been committed
+        if self.finished:
+            return 1
+        if not self.total_bytes or self.rows_parsed == 0:
+            return 0
+        return min(self.bytes_read / self.total_bytes, 1) * self.rows_committed / self.rows_parsed
+
+    @property
+    def eta(self):
+        # Seconds left at the current rate, or None until there is enough progress to estimate from
+        if self.fraction == 0:
+            return None
+        return self.elapsed * (1 - self.fraction) / self.fraction
+
+    def summary(self):
+        eta = '--:--:--' if self.eta is None else str(dt.timedelta(seconds=int(self.eta)))
+        return f'{self.bytes_read / 1e6:.1f} MB read | {self.rows_parsed} rows parsed | ' \
+               f'{self.rows_committed} rows committed | {self.rows_per_second:,.0f} rows/s | ' \
+               f'{self.mb_per_second:.1f} MB/s | ETA {eta}'
+
+
+def print_progress(progress, width=30):
+    # Redraws a single-line progress bar in the terminal
+    filled = int(progress.fraction * width)
+    bar = '#' * filled + '-' * (width - filled)
+    sys.stdout.write(f'\r[{bar}] {progress.fraction * 100:5.1f}% | {progress.summary()}')
+    if progress.finished:
+        sys.stdout.write('\n')
+    sys.stdout.flush()
@@ -5,10 +5,14 @@ querying, updating and inserting rows as well as creating tables.
 Author: Matthew MacDonald
 """
 import time
-import pandas as pd
 import datetime as dt
 
+from lazy import lazy_import
 from Database_Class import DatabaseConnection
+from progress import LoadProgress, print_progress
+
+# pandas is only needed once a CSV file is read, so it is not imported at start-up
+pd = lazy_import('pandas')
 
 
 def introduction():
@@ -90,7 +94,8 @@ def run():
         database_connection = DatabaseConnection(table)
         time.sleep(1)
         options = ' a --> Alter existing table \n ' \
-                  'c --> Create new table \n d --> Delete stuff \n i --> Insert rows \n ' \
+                  'c --> Create new table \n d --> Delete stuff \n f --> Find rows by text search \n ' \
+                  'i --> Insert rows \n m --> Match the table to a new full CSV \n ' \
                   'q --> Query data \n s --> Save the table as a CSV \n u --> Update rows \n'
         print(options)
         user_choice = input(
@@ -146,7 +151,17 @@ def run():
                 data = data.copy()
                 # Stores each column name in a list
                 columns = [column for column in data.columns]
-                database_connection.create_table(columns, data, id_included)
+                partition_by = input(
+                    'Partition the table by range, list or hash? Leave blank for no partitioning:    ')
+                if partition_by.strip():
+                    partition_column = input(
+                        'Which column should the table be partitioned on:    ')
+                    partition_interval = input('For range give day, month, year or a numeric width, '
+                                               'for hash give the number of partitions:    ')
+                    database_connection.create_table(columns, data, id_included, partition_by.strip(),
+                                                     partition_column, partition_interval.strip() or None)
+                else:
+                    database_connection.create_table(columns, data, id_included)
             # If file doesn't exist, issue is raised to user and process stopped
             except FileNotFoundError:
                 print('Sorry, that file does not exist, halting operation now...')
@@ -180,7 +195,15 @@ def run():
                             break
                     # Ensures rows are only deleted when conditions are specified if user has asked for them
                     if conditions is not None:
-                        database_connection.delete_rows(conditions)
+                        batch_str = input(
+                            'Rows to delete per batch (leave blank to delete in one statement):    ')
+                        try:
+                            batch_size = int(batch_str) if batch_str.strip() else None
+                        except ValueError:
+                            print('Batch size was not an integer, deleting in one statement')
+                            batch_size = None
+                        database_connection.delete_rows(
+                            conditions, batch_size=batch_size)
                 elif conditions_choice.lower() == 'n':
                     database_connection.delete_rows()
                 else:
@@ -190,20 +213,107 @@ def run():
             else:
                 print(
                     f'Sorry, {delete_choice} was not one of the options, halting operation now...')
+        elif user_choice == 'f':
+            index_choice = input('Would you like to build a search index first? f for full-text, t for trigram '
+                                 'and anything else to search straight away:    ')
+            if index_choice.lower() in ('f', 't'):
+                index_columns_str = input('Pass a list of text columns to index:    ')
+                index_columns = [item for item in index_columns_str.replace(',', ' ').split()]
+                database_connection.create_search_index(
+                    index_columns, method='fulltext' if index_choice.lower() == 'f' else 'trigram')
+            # The kind of search is decided by the indexes that exist, only asking when both are available
+            methods = database_connection.search_methods()
+            if len(methods) == 0:
+                print('Sorry, there is no search index on this table - build a full-text or trigram index first')
+            else:
+                text = input('What text would you like to search for:    ')
+                if len(methods) == 2:
+                    fuzzy_choice = input(
+                        'Would you like fuzzy matching that allows for typos? y for yes and n for no:    ')
+                    fuzzy = fuzzy_choice.lower() == 'y'
+                else:
+                    fuzzy = methods == ['trigram']
+                prefix_choice = input('Should words also match longer words they start? y for yes and n for no:    ')
+                if fuzzy:
+                    columns_str = input('Pass a list of columns to search (leave blank for every text column):    ')
+                    columns = [item for item in columns_str.replace(',', ' ').split()] or None
+                    df = database_connection.search(text, columns, fuzzy=True, prefix=prefix_choice.lower() == 'y')
+                else:
+                    df = database_connection.search(text, prefix=prefix_choice.lower() == 'y')
+                # Results come back with the best matches first
+                print(df)
         elif user_choice == 'i':
             print('To insert rows, a CSV file is needed containing the rows to be added')
             filepath = input('Please type the whole path of this data:    ')
+            reject_path = input(
+                'Path of a file to write invalid rows to (leave blank to load without validation):    ')
+            conflict_choice = input('If a row already exists: s to skip it, r to replace it, '
+                                    'anything else to insert as normal:    ')
+            on_conflict = {'s': 'skip', 'r': 'replace'}.get(conflict_choice.lower())
+            conflict_columns = None
+            if on_conflict is not None:
+                # Rows are matched on a unique key in the file, a generated id is new for every row
+                conflict_columns_str = input('Pass a list of the unique columns in the file that identify a row '
+                                             '(leave blank for the primary key):    ')
+                conflict_columns = [item for item in conflict_columns_str.replace(',', ' ').split()] or None
             try:
-                data = pd.read_csv(filepath)
-                data = data.copy()
-                columns = [column for column in data.columns]
-                database_connection.insert_rows(columns, data)
+                # Loads the file in parallel segments, drawing a progress bar as rows are committed
+                progress = LoadProgress(callback=print_progress)
+                database_connection.insert_csv(filepath, reject_path=reject_path.strip() or None,
+                                               on_conflict=on_conflict, conflict_columns=conflict_columns,
+                                               progress=progress)
+            except FileNotFoundError:
+                print('Sorry, that file does not exist, halting operation now...')
+            except ValueError as error:
+                print(f'{error}, halting operation now...')
+        elif user_choice == 'm':
+            print('Only rows that were added, changed or removed in the CSV will be written to the table')
+            filepath = input('Please type the whole path of this data:    ')
+            key = input('Which column identifies each row? Leave blank for id:    ').strip() or 'id'
+            dry_run_choice = input(
+                'Would you like to see the changes without applying them? y for yes and n for no:    ')
+            try:
+                database_connection.sync_csv(filepath, key=key, dry_run=dry_run_choice.lower() == 'y')
             except FileNotFoundError:
                 print('Sorry, that file does not exist, halting operation now...')
+            except ValueError as error:
+                print(f'{error}, halting operation now...')
         elif user_choice == 'q':
-            number_choice = input(
-                'Would you like to limit results? y for yes and n for no:    ')
-            if number_choice.lower() == 'y':
+            explain_choice = input(
+                'Would you like to see the query plan instead of the results? y for yes and n for no:    ')
+            # The plan summary has the same arguments as the query so either can be run from the choices below
+            if explain_choice.lower() == 'y':
+                run_query = database_connection.explain
+            else:
+                run_query = database_connection.query
+            threshold = input('Log the query with its plan if it takes longer than how many seconds? '
+                              'Leave blank to not log:    ')
+            try:
+                database_connection.slow_query_threshold = float(threshold) if threshold.strip() else None
+            except ValueError:
+                print('That was not a number, slow queries will not be logged')
+            number_choice = input('Would you like to limit results? y for yes, n for no '
+                                  'and p for a quick random sample of the table:    ')
+            if number_choice.lower() == 'p':
+                while True:
+                    row_number = input(
+                        'How many sample rows would you like to have returned:   ')
+                    try:
+                        row_number = int(row_number)
+                        break
+                    except ValueError:
+                        print('Please only input an integer value')
+                        continue
+                seed = input(
+                    'Give a seed to get the same sample each time, or leave blank for a new sample:    ')
+                try:
+                    seed = float(seed) if seed.strip() else None
+                except ValueError:
+                    print('That was not a number, a new sample will be taken')
+                    seed = None
+                df = database_connection.preview(row_number, seed=seed)
+                print(df)
+            elif number_choice.lower() == 'y':
                 while True:
                     row_number = input(
                         'How many results would you like to have returned:   ')
@@ -232,11 +342,11 @@ def run():
                         'Would you like to order the result? y for yes and n for no:    ')
                     if order_choice.lower() == 'y':
                         order = order_by_creator(database_connection)
-                        df = database_connection.query(
+                        df = run_query(
                             conditions, order, row_number)
                         print(df)
                     elif order_choice.lower() == 'n':
-                        df = database_connection.query(
+                        df = run_query(
                             conditions, row_number=row_number)
                         # This prints the resulting DataFrame, but can be modified to e.g. save to a CSV file
                         print(df)
@@ -248,11 +358,11 @@ def run():
                         'Would you like to order the result? y for yes and n for no:    ')
                     if order_choice.lower() == 'y':
                         order = order_by_creator(database_connection)
-                        df = database_connection.query(
+                        df = run_query(
                             order=order, row_number=row_number)
                         print(df)
                     elif order_choice.lower() == 'n':
-                        df = database_connection.query(row_number=row_number)
+                        df = run_query(row_number=row_number)
                         print(df)
                     else:
                         print(
@@ -278,10 +388,10 @@ def run():
                         'Would you like to order the result? y for yes and n for no:    ')
                     if order_choice.lower() == 'y':
                         order = order_by_creator(database_connection)
-                        df = database_connection.query(conditions, order)
+                        df = run_query(conditions, order)
                         print(df)
                     elif order_choice.lower() == 'n':
-                        df = database_connection.query(conditions)
+                        df = run_query(conditions)
                         print(df)
                     else:
                         print(
@@ -291,10 +401,10 @@ def run():
                         'Would you like to order the result? y for yes and n for no:    ')
                     if order_choice.lower() == 'y':
                         order = order_by_creator(database_connection)
-                        df = database_connection.query(order=order)
+                        df = run_query(order=order)
                         print(df)
                     elif order_choice.lower() == 'n':
-                        df = database_connection.query()
+                        df = run_query()
                         print(df)
                     else:
                         print(
@@ -308,8 +418,14 @@ def run():
         elif user_choice == 's':
             filepath = input(
                 'Please input the filepath you would like to save the file to:     ')
+            workers_str = input('How many connections should export in parallel? Leave blank to use one:    ')
+            try:
+                workers = int(workers_str) if workers_str.strip() else None
+            except ValueError:
+                print('That was not a whole number, exporting on one connection')
+                workers = None
             try:
-                database_connection.save_table(filepath)
+                database_connection.save_table(filepath, workers=workers)
             except FileNotFoundError:
                 print('Sorry, that directory does not exist, halting operation now...')
         elif user_choice == 'u':